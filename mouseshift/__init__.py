@@ -37,7 +37,8 @@ class ClientDB(object):
             token=client.token,
             topleft=(client.xlim[0],client.ylim[0]),
             bottomright=(client.xlim[1],client.ylim[1]), 
-            resolution=client.resolution
+            resolution=client.resolution,
+            relative=client.relative,
         ) 
         self.save()
 
@@ -49,11 +50,17 @@ config_dir = appdirs.user_config_dir("pymouseshift")
 dbpath = os.path.join(config_dir, "client_db.json")
 confpath = os.path.join(config_dir, "config.json")
 cert_dir = os.path.join(config_dir, 'server_certs')
+caps_dir = os.path.join(config_dir, 'capabilities')
+flight_dir = os.path.join(config_dir, 'flight')
 
 if not os.path.exists(config_dir):
     os.makedirs(config_dir, mode=0o700)
 if not os.path.exists(cert_dir):
     os.makedirs(cert_dir, mode=0o700)
+if not os.path.exists(caps_dir):
+    os.makedirs(caps_dir, mode=0o700)
+if not os.path.exists(flight_dir):
+    os.makedirs(flight_dir, mode=0o700)
 if not os.path.exists(dbpath):
     json.dump({}, open(dbpath, "w"))
 
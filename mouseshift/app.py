@@ -1,4 +1,5 @@
 import os
+import signal
 import asyncio
 import threading
 import logging
@@ -6,11 +7,12 @@ logger = logging.getLogger(__name__)
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 import pystray
 import PIL.Image
 
 from . import ui, net, config, save_config, cert_dir
+from .latency import LatencyProfile
 
 icon_path = os.path.abspath(os.path.split(__file__)[0])
 icon_empty = PIL.Image.open(os.path.join(icon_path, "mouse.png"))
@@ -22,6 +24,8 @@ class App(object):
             icon=icon_empty, 
             title="pymouseshift",
             menu=self.default_menu)
+        #preferences window is created once and reused
+        self.prefs = None
 
         #currently only linux server and clients supported
         #eventually need to do platform detection
@@ -29,14 +33,22 @@ class App(object):
         self.server_cls = linux.make_server
         self.client_cls = linux.LinuxClient
 
+        #kill -USR1 dumps the flight recorder of a running server
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.dump_recorder)
+
     @property
     def default_menu(self):
         #generate all the previous servers
-        servers = []
-        for server in config['servers']:
+        def item(server):
             def connect(icon, item):
                 self.start_client(server)
-            servers.append(pystray.MenuItem(server, connect))
+            return pystray.MenuItem(server, connect)
+
+        servers = [item(server) for server in config['servers']]
+        if len(config['servers']) > 1:
+            def auto(icon, item):
+                self.start_client(list(config['servers']))
+            servers.insert(0, pystray.MenuItem("Auto (first to answer)", auto))
 
         servers.append(pystray.MenuItem("+ Add new server", self.connect))
         client_menu = pystray.Menu(*servers)
@@ -48,16 +60,29 @@ class App(object):
         )
 
     def start_server(self, icon, item):
-        server = self.server_cls(app=self)
+        local_socket = net.SOCKET_PATH if config.get('local_socket', True) else None
+        server = self.server_cls(app=self, 
+            client_repeat=config.get('client_repeat', False),
+            passthrough=config.get('passthrough', False),
+            local_socket=local_socket)
 
-        loop = asyncio.new_event_loop()
+        profile = self.latency_profile()
+        loop = asyncio.new_event_loop() if profile is None else profile.new_event_loop()
         def target():
             asyncio.set_event_loop(loop)
+            if profile is not None:
+                profile.tune_thread()
             loop.run_until_complete(server.serve())
+            if profile is not None:
+                server.profile = profile
+                profile.started()
+                loop.create_task(profile.collect_when_idle(lambda: server.recorder.last))
             try:
                 loop.run_forever()
             finally:
                 loop.run_until_complete(loop.shutdown_asyncgens())
+                if profile is not None:
+                    profile.stopped()
 
         self.server, self.loop = server, loop
         self.thread = threading.Thread(target=target)
@@ -66,35 +91,118 @@ class App(object):
         menu = pystray.Menu(
             pystray.MenuItem("pymouseshift", None),
             pystray.MenuItem("Server Preferences", self.preferences),
+            pystray.MenuItem("Mirror input to", pystray.Menu(self.mirror_menu)),
+            pystray.MenuItem("Relative motion", pystray.Menu(self.relative_menu)),
+            pystray.MenuItem("Dump flight recorder", self.dump_recorder),
             pystray.MenuItem('Stop Server', self.stop),
             pystray.MenuItem("Quit", self.quit))
         icon.menu = menu
         icon.update_menu()
 
+    def mirror_menu(self):
+        """Checkbox for every connected client, to toggle mirroring to it"""
+        def item(client):
+            def toggle(icon, item):
+                self.call(self.server.toggle_mirror, client)
+            def checked(item):
+                return client in self.server.mirror
+            return pystray.MenuItem(client.hostname, toggle, checked=checked)
+
+        return [item(client) for client in self.server.clients]
+
+    def relative_menu(self):
+        """Checkbox for every connected client, to forward raw relative motion"""
+        def item(client):
+            def toggle(icon, item):
+                self.call(self.server.set_relative, client, not client.relative)
+            def checked(item):
+                return client.relative
+            return pystray.MenuItem(client.hostname, toggle, checked=checked)
+
+        return [item(client) for client in self.server.clients]
+
+    def dump_recorder(self, *args):
+        try:
+            server = self.server
+        except AttributeError:
+            return True
+        def dump():
+            return server.recorder.dump('Requested by user', extra=server.metrics())
+        self.call(dump, done=lambda path: logger.info(f'Dumping flight recorder to {path}'))
+        #keep the signal handler installed
+        return True
+
+    def call(self, func, *args, done=None):
+        """Run func on the server or client loop without waiting for it
+
+        This is the only way the UI thread touches the loop's state. If done is
+        given, it gets called with the result back on the UI thread.
+        """
+        def run():
+            result = func(*args)
+            if done is not None:
+                GLib.idle_add(done, result)
+        self.loop.call_soon_threadsafe(run)
+
+    def spawn(self, coro, done=None):
+        """Schedule a coroutine on the loop, calling done on the UI thread when it finishes"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if done is not None:
+            future.add_done_callback(lambda f: GLib.idle_add(done))
+
+    def latency_profile(self):
+        """LatencyProfile for a new server or client loop, if turned on in the config"""
+        if not config.get('latency_profile', False):
+            return None
+        if not hasattr(self, '_profile'):
+            #gc callbacks are global, so only ever make one
+            self._profile = LatencyProfile()
+        return self._profile
+
     def connect(self, icon, item):
         """Pops open a connect address dialog"""
         def callback(addr):
             logger.debug(f'Connecting to {addr}')
-            config['servers'].insert(0, addr)
-            if len(config['servers']) > 10:
-                config['servers'].pop()
-            save_config()
+            self.remember_server(addr)
             self.start_client(addr)
 
         ui.connect_dialog(callback)
 
+    def remember_server(self, addr):
+        """Move a server to the front of the saved list, most recently used first"""
+        if addr in config['servers']:
+            config['servers'].remove(addr)
+        config['servers'].insert(0, addr)
+        del config['servers'][10:]
+        save_config()
+
+    def connected(self, server):
+        """Called from the client loop once a server has answered"""
+        GLib.idle_add(self.remember_server, server)
+
     def start_client(self, addr):
         """Start up the client app
-        
+
+        addr can also be a list of servers, which are all tried at once
         """
-        self.client = self.client_cls()
+        self.client = client = self.client_cls(app=self)
 
-        self.loop = asyncio.new_event_loop()
+        profile = self.latency_profile()
+        self.loop = asyncio.new_event_loop() if profile is None else profile.new_event_loop()
 
         @net.protect_ssl(addr, retry=self.start_client)
         def target(addr):
             asyncio.set_event_loop(self.loop)
-            self.loop.run_until_complete(self.client.connect(addr))
+            if profile is not None:
+                profile.tune_thread()
+                profile.started()
+                self.loop.create_task(profile.collect_when_idle(lambda: client.last_activity))
+            try:
+                self.loop.run_until_complete(self.client.connect(addr))
+            finally:
+                #the connection can end without Disconnect being clicked
+                if profile is not None:
+                    profile.stopped()
 
         logger.debug('Starting client thread')
         self.thread = threading.Thread(target=target)
@@ -103,7 +211,7 @@ class App(object):
         logger.debug('Updating menu')
         menu = pystray.Menu(
             pystray.MenuItem("pymouseshift", None),
-            pystray.MenuItem(f'Disconnect from {addr}', self.stop),
+            pystray.MenuItem(f'Disconnect from {addr if isinstance(addr, str) else "auto"}', self.stop),
             pystray.MenuItem("Quit", self.quit))
         self.icon.menu = menu
         self.icon.update_menu()
@@ -112,56 +220,73 @@ class App(object):
     def stop(self, icon, item):
         """Gracefully exit either the server or client loops"""
         try:
-            self.server.stop()
+            self.call(self.server.stop)
             del self.server
         except AttributeError:
             pass
         try:
-            self.client.stop()
+            self.call(self.client.stop)
             del self.client
         except AttributeError:
             pass
         try:
-            self.loop.stop()
+            self.loop.call_soon_threadsafe(self.loop.stop)
             self.thread.join()
             del self.thread
             del self.loop
         except AttributeError:
             pass
 
+        if hasattr(self, '_profile'):
+            self._profile.stopped()
+
+        if self.prefs is not None:
+            self.prefs.clear()
+            self.prefs.hide()
+
         self.icon.menu = self.default_menu
         self.icon.update_menu()
         self.icon.icon = icon_empty
 
     def preferences(self, icon, item):
-        self.prefs = ui.ServerPrefs(self)
-        for client in self.server.clients:
+        if self.prefs is None:
+            self.prefs = ui.ServerPrefs(self)
+        for client in list(self.server.clients):
             self.prefs.add_client(client)
+        self.prefs.present()
 
     def confirm_client(self, client, reader, writer):
-        server, loop = self.server, self.loop
+        server = self.server
 
         def confirm():
-            coro = server.add_client(client, reader, writer)
-            future = asyncio.run_coroutine_threadsafe(coro, loop)
-            future.result()
-            self.preferences(None, None)
+            self.spawn(server.add_client(client, reader, writer), 
+                done=lambda: self.preferences(None, None))
 
         def cancel():
-            coro = server.deny_client(client, reader, writer)
-            future = asyncio.run_coroutine_threadsafe(coro, loop)
-            future.result()
+            self.spawn(server.deny_client(client, reader, writer))
 
         hostname, token, cert = client['hostname'], client['token'], server.cert_hash
         msg = f'Client <b>{hostname}</b> with token <i>{token}</i> is trying to connect, allow?\r\rServer ID: <tt>{cert}</tt>'
         ui.confirm_dialog(msg, confirm, cancel)
 
     def add_client(self, client):
-        self.icon.icon = icon_filled
+        """Called from the server loop, hands the update over to the UI thread"""
+        GLib.idle_add(self._client_added, client)
 
     def rm_client(self, client):
-        if len(self.server.clients) == 0:
+        """Called from the server loop, hands the update over to the UI thread"""
+        GLib.idle_add(self._client_removed, client)
+
+    def _client_added(self, client):
+        self.icon.icon = icon_filled
+        self.icon.update_menu()
+
+    def _client_removed(self, client):
+        if not hasattr(self, 'server') or len(self.server.clients) == 0:
             self.icon.icon = icon_empty
+        self.icon.update_menu()
+        if self.prefs is not None:
+            self.prefs.rm_client(client)
 
     def quit(self):
         self.stop(None, None)
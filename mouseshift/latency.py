@@ -0,0 +1,111 @@
+"""Opt-in low latency runtime profile
+
+Moves garbage collection out of the input path, asks for realtime scheduling
+of the input thread, and runs on uvloop if it's installed. Each setting that
+was actually applied is reported by `LatencyProfile.report`, along with the
+gc pauses seen since, so the effect on the tail latency can be checked.
+"""
+import gc
+import os
+import time
+import asyncio
+import threading
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+def percentile(values, pct):
+    """Nearest-rank percentile, None if there are no values"""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class LatencyProfile(object):
+    """Runtime tuning for the thread running the server or client loop
+
+    Call `new_event_loop` to make the loop, then `tune_thread` from the loop's
+    thread, and `started` once startup is done. `collect_when_idle` runs the
+    collections the automatic gc would have run, in the gaps between input.
+    """
+    def __init__(self, priority=10, idle=0.25, interval=0.5):
+        self.priority = priority
+        self.idle = idle
+        self.interval = interval
+        self.metrics = dict(loop='asyncio', scheduler='default', gc='automatic')
+
+        self.pauses = collections.deque(maxlen=4096)
+        self._gc_start = None
+        gc.callbacks.append(self._gc_callback)
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            self.pauses.append(time.perf_counter() - self._gc_start)
+            self._gc_start = None
+
+    def new_event_loop(self):
+        try:
+            import uvloop
+        except ImportError:
+            return asyncio.new_event_loop()
+        self.metrics['loop'] = f'uvloop {uvloop.__version__}'
+        return uvloop.new_event_loop()
+
+    def tune_thread(self):
+        """Ask for realtime scheduling of the calling thread
+
+        Falls back to raising its nice level, and to nothing if neither is
+        permitted.
+        """
+        try:
+            #on linux, pid 0 is the calling thread rather than the whole process
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+            self.metrics['scheduler'] = f'SCHED_FIFO priority {self.priority}'
+        except (AttributeError, OSError):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10)
+                self.metrics['scheduler'] = 'nice -10'
+            except (AttributeError, OSError):
+                self.metrics['scheduler'] = 'default, elevation not permitted'
+        logger.info(f"Input thread scheduling: {self.metrics['scheduler']}")
+
+    def started(self):
+        """Freeze everything allocated during startup and turn off the automatic gc"""
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self.metrics['gc'] = f'{gc.get_freeze_count()} objects frozen, collected when idle'
+
+    def stopped(self):
+        """Hand collection back to the automatic gc once the loop is gone"""
+        #so a restart doesn't freeze another batch on top of this one
+        gc.unfreeze()
+        gc.enable()
+        self.metrics['gc'] = 'automatic'
+
+    async def collect_when_idle(self, last_activity, full_every=120):
+        """Collect whenever there's been no input for a little while
+
+        last_activity returns the monotonic time of the latest input. If input
+        never stops, collect anyway once garbage piles up far past the usual
+        threshold.
+        """
+        threshold = gc.get_threshold()[0]
+        rounds = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            count = gc.get_count()[0]
+            idle = time.monotonic() - last_activity() >= self.idle
+            if count > 0 and (idle or count > 50 * threshold):
+                rounds += 1
+                gc.collect(2 if rounds % full_every == 0 else 1)
+
+    def report(self):
+        pauses = [p * 1000 for p in self.pauses]
+        return dict(self.metrics,
+            gc_pauses=len(pauses),
+            gc_pause_p99_ms=percentile(pauses, 99),
+            gc_pause_max_ms=max(pauses, default=None))
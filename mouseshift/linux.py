@@ -1,3 +1,7 @@
+import os
+import sys
+import struct
+import ctypes
 import asyncio
 import json
 import socket
@@ -6,8 +10,8 @@ import evdev
 import logging
 logger = logging.getLogger(__name__)
 
-from . import enums
-from .net import Server, Client
+from . import enums, config_dir
+from .net import Server, Client, EVENT_FORMAT
 
 import gi
 gi.require_version("Gtk", "3.0")
@@ -15,11 +19,160 @@ from gi.repository import Gtk, Gdk, Gio, GLib
 
 resolution = Gdk.Screen.width(), Gdk.Screen.height()
 
+#uinput devices stay alive across client reconnections, keyed by capability hash
+#so the desktop doesn't have to rediscover a new device every time
+_devices = dict()
+
+#native struct input_event, if it matches the wire layout frames are written as is
+NATIVE_EVENT = struct.Struct('llHHi')
+NATIVE_FRAMES = NATIVE_EVENT.size == EVENT_FORMAT.size and sys.byteorder == 'little'
+
+devices_path = os.path.join(config_dir, "devices.json")
+#uinput devices show up on the virtual bus, ours carry python-evdev's default name
+BUS_VIRTUAL = 0x06
+UINPUT_NAME = 'py-evdev-uinput'
+#bumped when the classification changes, so cached kinds are redone
+REGISTRY_VERSION = 2
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class DeviceRegistry(object):
+    """Finds the mice and keyboards among the input devices
+
+    Devices are classified by their capabilities. The kind of each device is
+    cached on disk by its identity (bus, vendor, product, name and phys) which
+    is read from sysfs, so known devices don't have to be opened at startup.
+    """
+    def __init__(self, jspath=devices_path):
+        self.jspath = jspath
+        try:
+            self.kinds = json.load(open(jspath, "r"))
+        except (OSError, json.decoder.JSONDecodeError):
+            self.kinds = dict()
+        if self.kinds.get('version') != REGISTRY_VERSION:
+            #virtual devices used to all be skipped, classify them again
+            self.kinds = dict((ident, kind) for ident, kind in self.kinds.items()
+                if kind is not None and ident != 'version')
+            self.kinds['version'] = REGISTRY_VERSION
+
+    def save(self):
+        json.dump(self.kinds, open(self.jspath, "w"))
+
+    @staticmethod
+    def identity(path):
+        """Read the identity of a device node from sysfs"""
+        sysfs = os.path.join('/sys/class/input', os.path.basename(path), 'device')
+        def read(name):
+            with open(os.path.join(sysfs, name)) as fp:
+                return fp.read().strip()
+        return ','.join((read('id/bustype'), read('id/vendor'), read('id/product'), 
+            read('name'), read('phys')))
+
+    def classify(self, path):
+        """Returns 'mouse', 'keyboard' or None for the device at path"""
+        try:
+            ident = self.identity(path)
+        except OSError:
+            ident = None
+        if ident in self.kinds:
+            return self.kinds[ident]
+
+        dev = evdev.InputDevice(path)
+        caps = dev.capabilities()
+        bustype, name = dev.info.bustype, dev.name
+        dev.close()
+
+        rel, keys = caps.get(enums.EV_REL, []), caps.get(enums.EV_KEY, [])
+        kind = None
+        if bustype == BUS_VIRTUAL and name == UINPUT_NAME:
+            #our own devices, other virtual ones like keyd's keyboard are fair game
+            pass
+        elif enums.REL_X in rel and enums.REL_Y in rel and enums.BTN_LEFT in keys:
+            kind = 'mouse'
+        elif enums.KEY_A in keys and enums.KEY_Z in keys and enums.KEY_ENTER in keys:
+            kind = 'keyboard'
+
+        if ident is not None:
+            self.kinds[ident] = kind
+        return kind
+
+    def scan(self):
+        """Returns the paths of all the mice and keyboards"""
+        mice, keyboards = [], []
+        for path in evdev.list_devices():
+            try:
+                kind = self.classify(path)
+            except OSError:
+                #no permission, or it went away
+                continue
+            if kind == 'mouse':
+                mice.append(path)
+            elif kind == 'keyboard':
+                keyboards.append(path)
+        self.save()
+        return mice, keyboards
+
+    async def watch(self, root='/dev/input'):
+        """Yields ('add' or 'remove', path) as event devices come and go
+
+        Uses inotify if libc has it, otherwise polls the device list.
+        """
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            fd = -1
+        if fd < 0 or libc.inotify_add_watch(fd, root.encode(), IN_CREATE | IN_DELETE) < 0:
+            logger.warning('inotify unavailable, polling for input devices')
+            async for change in self.poll():
+                yield change
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        def readable():
+            try:
+                queue.put_nowait(os.read(fd, 4096))
+            except BlockingIOError:
+                pass
+        loop.add_reader(fd, readable)
+        try:
+            while True:
+                buf = await queue.get()
+                offset = 0
+                while offset < len(buf):
+                    wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                    start = offset + INOTIFY_EVENT.size
+                    name = buf[start:start+length].rstrip(b'\0').decode()
+                    offset = start + length
+                    if name.startswith('event'):
+                        yield 'add' if mask & IN_CREATE else 'remove', os.path.join(root, name)
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+    async def poll(self, interval=2):
+        known = set(evdev.list_devices())
+        while True:
+            await asyncio.sleep(interval)
+            current = set(evdev.list_devices())
+            for path in current - known:
+                yield 'add', path
+            for path in known - current:
+                yield 'remove', path
+            known = current
+
 class LinuxServer(Server):
-    def __init__(self, mouse, keyboards, **kwargs):
-        self.mouse = evdev.InputDevice(mouse)
+    def __init__(self, mice, keyboards, registry=None, **kwargs):
+        self.registry = registry
+        self.mice = [evdev.InputDevice(mouse) for mouse in mice]
         self.keyboards = [evdev.InputDevice(kbd) for kbd in keyboards]
-        self.mouse.grab()
+        #the first mouse provides the capabilities for the local device
+        self.mouse = self.mice[0]
+        if not kwargs.get('passthrough', False):
+            for mouse in self.mice:
+                mouse.grab()
 
         #get mouse capabilities to forward to absolute device
         caps = self.mouse.capabilities()
@@ -44,25 +197,115 @@ class LinuxServer(Server):
                 else:
                     self.capabilities[k].extend(v)
         
-        self.dev = evdev.UInput(caps)
+        dev_caps = caps
+        if kwargs.get('passthrough', False):
+            #with passthrough the local pointer is only ever moved relatively
+            dev_caps = dict(caps)
+            dev_caps[enums.EV_REL] = sorted(set(caps[enums.EV_REL]) | {enums.REL_X, enums.REL_Y})
+            del dev_caps[enums.EV_ABS]
+        self.dev = evdev.UInput(dev_caps)
+
+        if len(self.keyboards) > 0:
+            #EVIOCGREP gives the repeat delay then the period, both in ms
+            self.repeat = tuple(self.keyboards[0].repeat)
 
         super(LinuxServer, self).__init__(resolution, **kwargs)
 
     async def serve(self):
-        self.task_mouse = asyncio.create_task(self.readmouse())
-        self.task_kbds = []
+        #reader task for each device, by path
+        self.tasks = dict()
+        for mouse in self.mice:
+            self.tasks[mouse.path] = asyncio.create_task(self.readmouse(mouse))
         for kbd in self.keyboards:
-            task = asyncio.create_task(self.readkbd(kbd))
-            self.task_kbds.append(task)
+            self.tasks[kbd.path] = asyncio.create_task(self.readkbd(kbd))
+        self.task_hotplug = None
+        if self.registry is not None:
+            self.task_hotplug = asyncio.create_task(self.hotplug())
 
         await super(LinuxServer, self).serve()
 
+    async def hotplug(self):
+        async for action, path in self.registry.watch():
+            try:
+                if action == 'remove':
+                    if path in self.tasks:
+                        self.remove_device(path)
+                    continue
+                #give udev a moment to set the permissions on the new node, known
+                #devices aren't opened by classify so open them here too
+                dev = None
+                for retry in range(5):
+                    await asyncio.sleep(0.5)
+                    try:
+                        kind = self.registry.classify(path)
+                        if kind is not None:
+                            dev = evdev.InputDevice(path)
+                        break
+                    except FileNotFoundError:
+                        #unplugged again already
+                        break
+                    except OSError:
+                        pass
+                if dev is not None:
+                    self.add_device(dev, kind)
+                    self.registry.save()
+            except OSError as e:
+                #one bad device shouldn't stop the watcher
+                logger.warning(f'Could not {action} device {path}: {e}')
+
+    def add_device(self, dev, kind):
+        path = dev.path
+        logger.info(f'Adding {kind} {path}')
+        if kind == 'mouse':
+            if self.mouse_grabbed:
+                dev.grab()
+            self.mice.append(dev)
+            self.tasks[path] = asyncio.create_task(self.readmouse(dev))
+        else:
+            if self._last_screen:
+                dev.grab()
+            self.keyboards.append(dev)
+            self.tasks[path] = asyncio.create_task(self.readkbd(dev))
+
+    def remove_device(self, path):
+        logger.info(f'Removing device {path}')
+        task = self.tasks.pop(path, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        for devs in (self.mice, self.keyboards):
+            for dev in [d for d in devs if d.path == path]:
+                devs.remove(dev)
+                try:
+                    dev.close()
+                except OSError:
+                    pass
+
+    def grab_mouse(self, grabbed=True):
+        if any(len(mouse.active_keys()) > 0 for mouse in self.mice):
+            #a button released across the grab would stay stuck on whichever
+            #device saw the press, so wait until they're all up
+            return
+        for mouse in self.mice:
+            try:
+                if grabbed:
+                    mouse.grab()
+                else:
+                    mouse.ungrab()
+            except OSError:
+                pass
+        self.mouse_grabbed = grabbed
+        logger.debug(f"Mouse {'grabbed' if grabbed else 'released to the kernel'}")
+
     def grab_keyboard(self, grabbed=True):
         for kbd in self.keyboards:
-            if grabbed:
-                kbd.grab()
-            else:
-                kbd.ungrab()
+            try:
+                if grabbed:
+                    kbd.grab()
+                else:
+                    kbd.ungrab()
+            except OSError:
+                #unplugged, the hotplug watcher will drop it
+                pass
 
     def local_event(self, event):
         if event.type == enums.SYN_REPORT:
@@ -70,66 +313,146 @@ class LinuxServer(Server):
         else:
             self.dev.write(event.type, event.code, event.value)
 
-    async def readmouse(self):
-        async for ev in self.mouse.async_read_loop():
-            await self.handle_mouse(ev)
+    async def readmouse(self, mouse):
+        try:
+            async for ev in mouse.async_read_loop():
+                await self.handle_mouse(ev)
+        except OSError:
+            #device was unplugged
+            self.remove_device(mouse.path)
 
     async def readkbd(self, keyboard):
-        async for ev in keyboard.async_read_loop():
-            await self.handle_keyboard(ev)
+        try:
+            async for ev in keyboard.async_read_loop():
+                await self.handle_keyboard(ev)
+        except OSError:
+            self.remove_device(keyboard.path)
 
     def stop(self):
         logger.info("Shutting down server")
         super(LinuxServer, self).stop()
-        self.mouse.ungrab()
-        self.task_mouse.cancel()
-        for task in self.task_kbds:
+        for mouse in self.mice:
+            try:
+                mouse.ungrab()
+            except OSError:
+                pass
+        if self.task_hotplug is not None:
+            self.task_hotplug.cancel()
+        for task in self.tasks.values():
             task.cancel()
 
 class LinuxClient(Client):
+    encodings = ('evbin', 'json')
+    synth_repeat = True
+
     def __init__(self, **kwargs):
         super(LinuxClient, self).__init__(**kwargs)
         self.dev = None
         self.running = True
+        self.repeats = dict()
 
     async def connect(self, server):
         caps = await super(LinuxClient, self).connect(server, resolution)
         #caps may be None if user rejects server cert request
         if caps is not None:
             self.capabilities = dict((int(k), v) for k, v in caps.items())
-            self.dev = evdev.UInput(self.capabilities)
-            logger.debug(f'Received capabilities: {self.capabilities}')
+            try:
+                self.dev = _devices[self.caps_hash]
+                logger.debug(f'Reusing device for capabilities {self.caps_hash}')
+            except KeyError:
+                self.dev = evdev.UInput(self.capabilities)
+                _devices[self.caps_hash] = self.dev
+                logger.debug(f'Received capabilities: {self.capabilities}')
             await self.handle_event()
 
     async def handle_event(self):
-        while self.running:
-            try:
-                ev = await self.handle_heartbeat()
-            except json.decoder.JSONDecodeError:
-                #No json received, quit out of loop
-                self.running = False
-            try:
-                if ev['type'] == enums.SYN_REPORT:
-                    self.dev.syn()
-                else:
-                    self.dev.write(ev['type'], ev['code'], ev['value'])
-            except KeyError:
-                logger.debug(f'Invalid event: {ev}')
+        try:
+            while self.running:
+                try:
+                    ev = await self.handle_heartbeat()
+                except json.decoder.JSONDecodeError:
+                    #No json received, quit out of loop
+                    self.running = False
+                    break
+                if isinstance(ev, bytes):
+                    self.inject_frame(ev)
+                    continue
+                try:
+                    if 'events' in ev:
+                        #a whole frame of mirrored events
+                        for evtype, code, value in ev['events']:
+                            self.inject(evtype, code, value)
+                    else:
+                        self.inject(ev['type'], ev['code'], ev['value'])
+                except KeyError:
+                    logger.debug(f'Invalid event: {ev}')
+        finally:
+            self.release_keys()
+
+    def inject(self, evtype, code, value):
+        if evtype == enums.SYN_REPORT:
+            self.dev.syn()
+        else:
+            self.dev.write(evtype, code, value)
+            if self.repeat is not None and evtype == enums.EV_KEY:
+                self.autorepeat(code, value)
+
+    def inject_frame(self, frame):
+        """Write a binary frame into uinput with a single write"""
+        if self.repeat is not None:
+            for _, _, evtype, code, value in EVENT_FORMAT.iter_unpack(frame):
+                if evtype == enums.EV_KEY:
+                    self.autorepeat(code, value)
+        if not NATIVE_FRAMES:
+            #e.g. 32 bit platforms, where the timeval is smaller
+            frame = b''.join(NATIVE_EVENT.pack(0, 0, evtype, code, value)
+                for _, _, evtype, code, value in EVENT_FORMAT.iter_unpack(frame))
+        os.write(self.dev.fd, frame)
+
+    def autorepeat(self, code, value):
+        """Start or stop synthesizing repeats for a key"""
+        task = self.repeats.pop(code, None)
+        if task is not None:
+            task.cancel()
+        #only keyboard keys repeat, not mouse buttons
+        if value == 1 and code < enums.BTN_MISC:
+            self.repeats[code] = asyncio.create_task(self.repeat_key(code))
+
+    async def repeat_key(self, code):
+        delay, period = self.repeat
+        if period <= 0:
+            return
+        await asyncio.sleep(delay / 1000)
+        while True:
+            self.dev.write(enums.EV_KEY, code, 2)
+            self.dev.syn()
+            await asyncio.sleep(period / 1000)
+
+    def release_keys(self):
+        """Release all keys so nothing stays stuck down when the connection drops
+
+        The kernel drops releases for keys that aren't down, so there's no need
+        to track which ones are held.
+        """
+        for task in self.repeats.values():
+            task.cancel()
+        self.repeats.clear()
+        if self.dev is None:
+            return
+        for code in self.capabilities.get(enums.EV_KEY, []):
+            self.dev.write(enums.EV_KEY, code, 0)
+        self.dev.syn()
 
     def stop(self):
         self.running = False
+        self.release_keys()
 
-def find_devs():
-    mouse = None
-    keyboard = []
-    for dev in evdev.list_devices():
-        dev = evdev.InputDevice(dev)
-        if "mouse" in dev.name.lower():
-            mouse = dev.path
-        elif "keyboard" in dev.name.lower():
-            keyboard.append(dev.path)
-    return mouse, keyboard
+def find_devs(registry=None):
+    if registry is None:
+        registry = DeviceRegistry()
+    return registry.scan()
 
 def make_server(**kwargs):
-    mouse, keyboards = find_devs()
-    return LinuxServer(mouse, keyboards, **kwargs)
+    registry = DeviceRegistry()
+    mice, keyboards = find_devs(registry)
+    return LinuxServer(mice, keyboards, registry=registry, **kwargs)
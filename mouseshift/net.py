@@ -4,6 +4,10 @@ import json
 import socket
 import time
 import ssl
+import zlib
+import base64
+import struct
+import hashlib
 
 import logging
 logger = logging.getLogger(__name__)
@@ -11,9 +15,21 @@ logger = logging.getLogger(__name__)
 from OpenSSL import crypto
 from gi.repository import GLib
 
-from . import db, config, config_dir, cert_dir, enums, clamp, Event, ui
+from . import db, config, config_dir, cert_dir, caps_dir, enums, clamp, Event, ui
+from .recorder import FlightRecorder, EVENT, SEND, HEARTBEAT, CONNECT, REMOVE
 
 PORT = 8976
+#version 1 hellos have no version field, 2 adds feature negotiation
+PROTOCOL_VERSION = 2
+#features this side supports, fastest first
+ENCODINGS = ('evbin', 'json')
+COMPRESSION = ('zlib',)
+#hi-res wheel units in one detent
+WHEEL_DETENT = 120
+#unix socket for clients on the same host, addressed as "unix:" or "unix:/path"
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', config_dir), 'pymouseshift.sock')
+#number of capability descriptors a client keeps on disk
+CAPS_CACHE_SIZE = 16
 
 def gen_cert(name=socket.gethostname()):
     """Generate a self-signed certificate to encrypt traffic"""
@@ -33,29 +49,131 @@ def gen_cert(name=socket.gethostname()):
     with open(os.path.join(config_dir, f'{name}.key'), 'wt') as fp:
         fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode('utf-8'))
 
+def caps_hash(caps):
+    """Content hash identifying a capabilities dict"""
+    return hashlib.sha1(json.dumps(caps, sort_keys=True).encode()).hexdigest()
+
+def cached_caps():
+    """List the hashes of the capabilities cached on disk, newest first"""
+    paths = [os.path.join(caps_dir, f) for f in os.listdir(caps_dir) if f.endswith('.json')]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return [os.path.splitext(os.path.basename(p))[0] for p in paths]
+
+def load_caps(digest):
+    path = os.path.join(caps_dir, f'{digest}.json')
+    with open(path) as fp:
+        caps = json.load(fp)
+    #bump the mtime so this entry survives pruning
+    os.utime(path)
+    return caps
+
+def save_caps(digest, caps):
+    with open(os.path.join(caps_dir, f'{digest}.json'), 'wt') as fp:
+        json.dump(caps, fp)
+    for old in cached_caps()[CAPS_CACHE_SIZE:]:
+        os.remove(os.path.join(caps_dir, f'{old}.json'))
+
 """Implement a dirt simple communication method:
 4 byte integer with the number of bytes
-n bytes json-encoded dict with data"""
+n bytes json-encoded dict with data
+
+Clients that support it get input as binary frames instead, flagged by the top
+bit of the length. The payload is a packed array of struct input_event which
+the client can write straight into uinput.
+
+The client's hello carries a protocol version and the features it supports,
+and the server answers with the ones it picked in its first message. Peers
+without a version speak version 1: plain json, one event per message."""
 async def _xfer(writer, obj):
     obj_buf = json.dumps(obj).encode()
     writer.write(len(obj_buf).to_bytes(4, 'big'))
     writer.write(obj_buf)
     #await writer.drain()
 
+#wire layout of a struct input_event, the timestamp is left zero
+EVENT_FORMAT = struct.Struct('<qqHHi')
+SYN_EVENT = EVENT_FORMAT.pack(0, 0, 0, 0, 0)
+#set in the length prefix of a binary frame
+BINARY_FRAME = 1 << 31
+
+def _frame_header(nbytes):
+    return (nbytes | BINARY_FRAME).to_bytes(4, 'big')
+
 async def _recv(reader):
+    """Receive the next message, binary frames are returned as bytes"""
     size = await reader.read(4)
     nbytes = int.from_bytes(size, 'big')
+    if nbytes & BINARY_FRAME:
+        return await reader.readexactly(nbytes & ~BINARY_FRAME)
     buf = await reader.read(nbytes)
     return json.loads(buf.decode())
 
+def _is_repeat(ev):
+    """Kernel autorepeats and scan codes, which clients synthesizing their own
+    repeats don't get"""
+    return ev.type == enums.EV_MSC or (ev.type == enums.EV_KEY and ev.value == 2)
+
+#digits reserved for each ABS value in a mirrored frame
+SLOT_WIDTH = 6
+
+def _encode_frame(events, binary=False):
+    """Serialize a frame of events once, for every client it gets mirrored to
+
+    ABS values are written as fixed-width slots padded with spaces (valid JSON
+    whitespace), so each client's scaling can be patched into a copy of the
+    buffer without encoding the frame again. Returns the framed buffer and the
+    (offset, code, value) of every slot.
+    """
+    if binary:
+        buf = b''.join(EVENT_FORMAT.pack(0, 0, *ev) for ev in events)
+        slots = [(4 + i*EVENT_FORMAT.size + 20, ev.code, ev.value) 
+            for i, ev in enumerate(events) if ev.type == enums.EV_ABS]
+        return _frame_header(len(buf)) + buf, slots
+
+    buf = bytearray(b'{"events": [')
+    slots = []
+    for i, ev in enumerate(events):
+        if i > 0:
+            buf += b', '
+        if ev.type == enums.EV_ABS:
+            buf += b'[%d, %d, ' % (ev.type, ev.code)
+            slots.append((len(buf) + 4, ev.code, ev.value))
+            buf += b' ' * SLOT_WIDTH + b']'
+        else:
+            buf += b'[%d, %d, %d]' % (ev.type, ev.code, ev.value)
+    buf += b']}'
+    return len(buf).to_bytes(4, 'big') + buf, slots
+
 class Server(object):
     """Abstract base class for different platforms
 
     Implements the basic server to shift the mouse pointer
     """
-    def __init__(self, screen, accel=1.8, app=None):
+    #releases the pointer from a relative client, so it can leave again
+    unlock_key = enums.KEY_SCROLLLOCK
+    #keyboard repeat delay and period in ms, overridden by the platform
+    repeat = (250, 33)
+
+    def __init__(self, screen, accel=1.8, app=None, client_repeat=False, local_socket=None,
+        passthrough=False, edge_margin=50):
         self.name = socket.gethostname()
         self.accel = accel
+        #only forward key down/up to clients that can synthesize the repeats
+        self.client_repeat = client_repeat
+        #path of the unix socket for same-host clients, and the users allowed on it
+        self.local_socket = local_socket
+        self.local_uids = {os.getuid(), 0}
+        #let local motion go through the kernel, grabbing the mouse only near
+        #edges with a client behind them
+        self.passthrough = passthrough
+        self.edge_margin = edge_margin
+        self.mouse_grabbed = not passthrough
+        self.edges = []
+        #whether the estimate was clamped at the screen edge on each axis
+        self._pinned = [False, False]
+        self.recorder = FlightRecorder()
+        #LatencyProfile, if the loop was set up with one
+        self.profile = None
         self.pos = [0, 0]
         self.screen = screen
         self.buffer_size = [0,0,screen[0],screen[1]]
@@ -63,6 +181,30 @@ class Server(object):
         self.app = app
 
         self._last_screen = False
+        #client the pointer was on at the last report, and the relative client
+        #it's confined to
+        self._active = None
+        self.locked = None
+        #whether this mouse frame has anything besides scroll in it
+        self._mouse_pending = False
+        #clients receiving a copy of the local input, and the frame being built for them
+        self.mirror = []
+        self._frame = []
+        #clients with binary frames waiting to be written
+        self._unsent = set()
+
+        #scroll going to clients is coalesced in hi-res units, at most one
+        #flush per scroll_interval, with the sub-detent remainder carried over
+        self.scroll_interval = 1 / 120
+        self._hires = {enums.REL_WHEEL: enums.REL_WHEEL_HI_RES, enums.REL_HWHEEL: enums.REL_HWHEEL_HI_RES}
+        self._lores = dict((v, k) for k, v in self._hires.items())
+        self._scroll_frame = dict()
+        self._scroll_hires = set()
+        self._scroll_pending = dict()
+        self._scroll_rem = dict()
+        self._scroll_flushed = 0
+        self._scroll_timer = None
+        self._scroll_task = None
         self.running = True
 
         #load the server certificate 
@@ -90,9 +232,32 @@ class Server(object):
         """
         server = await asyncio.start_server(self.client_connect, '0.0.0.0', PORT, ssl=self.sslctx)
         self.hbtask = asyncio.create_task(self.heartbeat())
-        logger.info(f'Starting server on {server.sockets[0].getsockname()}')
+        logger.info('Starting server on %s', server.sockets[0].getsockname())
         self.server_task = asyncio.create_task(server.serve_forever())
 
+        self.local_task = None
+        if self.local_socket is not None:
+            if os.path.exists(self.local_socket):
+                #stale socket from a previous run
+                os.remove(self.local_socket)
+            local = await asyncio.start_unix_server(self.local_connect, path=self.local_socket)
+            logger.info('Listening for local clients on %s', self.local_socket)
+            self.local_task = asyncio.create_task(local.serve_forever())
+
+    async def local_connect(self, reader, writer):
+        """Handles a client connecting over the unix socket
+
+        There's no TLS on the unix socket, the peer credentials are checked instead
+        """
+        sock = writer.get_extra_info('socket')
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        if uid not in self.local_uids:
+            logger.warning('Rejecting local client pid %d with uid %d', pid, uid)
+            writer.close()
+            return
+        await self.client_connect(reader, writer)
+
     async def client_connect(self, reader, writer):
         """Handles a new client connecting
 
@@ -100,15 +265,18 @@ class Server(object):
         """
         try:
             client = await _recv(reader)
+            #the version and features are negotiated, the rest describes the client
+            features = self.negotiate(client.pop('version', 1), client.pop('features', dict()))
             try:
-                logger.debug(f"Client {client['hostname']} connecting...")
+                logger.debug("Client %s connecting...", client['hostname'])
                 client = db.get_client(client['hostname'], client['token'])
-                await self.add_client(client, reader, writer)
+                await self.add_client(client, reader, writer, features)
             except KeyError:
                 #Unknown client, confirm with user
                 res = client['resolution']
                 client['topleft'] = self.buffer_size[2], 0
                 client['bottomright'] = self.buffer_size[2]+res[0], res[1]
+                client['features'] = features
 
                 if self.app is not None:
                     #if there's an app, pop up a message to confirm
@@ -120,9 +288,29 @@ class Server(object):
             #Cert query doesn't transmit json, ignore
             pass
 
-    async def add_client(self, client, reader, writer):
+    def negotiate(self, version, offered):
+        """Pick the fastest set of features supported by both sides"""
+        if version < 2:
+            return dict(version=1, encoding='json', batching=False, compression=None, 
+                repeat=False, caps_cache=[])
+
+        def pick(ours, theirs):
+            return next((f for f in ours if f in theirs), None)
+        encoding = pick(ENCODINGS, offered.get('encodings', ())) or 'json'
+        return dict(
+            version=min(version, PROTOCOL_VERSION),
+            encoding=encoding,
+            #binary frames are always batched
+            batching=encoding == 'evbin' or bool(offered.get('batching', False)),
+            compression=pick(COMPRESSION, offered.get('compression', ())),
+            repeat=self.client_repeat and bool(offered.get('repeat', False)),
+            caps_cache=offered.get('caps_cache', []))
+
+    async def add_client(self, client, reader, writer, features=None):
+        if features is None:
+            features = client.pop('features', None) or self.negotiate(1, None)
         client = Client(**client)
-        logger.debug(f'Client {client.hostname} confirmed')
+        logger.debug('Client %s confirmed', client.hostname)
         if client not in db:
             db.update_client(client)
         if self.app is not None:
@@ -134,33 +322,89 @@ class Server(object):
                 max(self.buffer_size[2], client.xlim[1]),
                 max(self.buffer_size[3], client.ylim[1]),
             ]
-        logger.debug(f'New screen size: {self.buffer_size}')
+        logger.debug('New screen size: %s', self.buffer_size)
         client.reader = reader
         client.writer = writer
+        client.binary = features['encoding'] == 'evbin'
+        client.batching = features['batching']
+        #client synthesizes key repeats, and whether it was sent anything since the last SYN
+        client.synth_repeat = features['repeat']
+        client.pending = False
+        #keys and buttons down on the client, released when the pointer leaves it
+        client.held = set()
+        #events waiting for the end of the frame, packed or as lists for json
+        client.frame = bytearray()
+        client.events = []
         self.clients.append(client)
+        self.update_edges()
         #Add the absolute axes for this client
         caps = dict(self.capabilities)
-        #caps[enums.EV_REL].remove(enums.REL_X)
-        #caps[enums.EV_REL].remove(enums.REL_Y)
+        #keep the relative axes too, so the client can be switched to raw motion
+        caps[enums.EV_REL] = sorted(set(caps.get(enums.EV_REL, [])) | {enums.REL_X, enums.REL_Y})
         caps[enums.EV_ABS] = [
             (enums.ABS_X, (0,0,client.resolution[0],0,0,0)),
             (enums.ABS_Y, (0,0,client.resolution[1],0,0,0))]
 
-        await _xfer(writer, caps)
-        logger.info(f"Client {client.hostname} connected")
+        #skip sending the full capabilities if the client has them cached
+        digest = caps_hash(caps)
+        msg = dict(caps_hash=digest)
+        if features['version'] >= 2:
+            msg['version'] = features['version']
+            msg['features'] = dict((k, v) for k, v in features.items() if k != 'caps_cache')
+        if digest in features['caps_cache']:
+            pass
+        elif features['compression'] == 'zlib':
+            packed = zlib.compress(json.dumps(caps).encode())
+            msg['capabilities_zlib'] = base64.b64encode(packed).decode()
+        else:
+            msg['capabilities'] = caps
+        if client.synth_repeat:
+            msg['repeat'] = list(self.repeat)
+        if features['version'] < 2:
+            #version 1 clients expect the bare capabilities
+            msg = caps
+        await _xfer(writer, msg)
+        logger.info("Client %s connected", client.hostname)
+        self.recorder.record(CONNECT, *client.resolution, note=client.hostname)
 
-    def remove_client(self, client):
-        logger.info(f'Removing client {client.hostname}')
+    def remove_client(self, client, reason=''):
+        if client not in self.clients:
+            #already removed by a failed send or heartbeat
+            return
+        logger.info('Removing client %s: %s', client.hostname, reason)
+        self.recorder.record(REMOVE, len(self.clients) - 1, note=(client.hostname, reason))
+        self.recorder.dump(f'Removed client {client.hostname}: {reason}', auto=True, 
+            extra=self.metrics())
         # client.reader.close()
         # client.writer.close()
         # logger.debug(f'Client {client.hostname} sockets closed')
 
         self.clients.remove(client)
+        if self.locked is client:
+            self.locked = None
+        if self._active is client:
+            self._active = None
+        if client in self.mirror:
+            self.mirror.remove(client)
+        self._unsent.discard(client)
         if self.app is not None:
             self.app.rm_client(client)
         #do math to remove the client from the screen
         self.update_buffer()
 
+    def move_client(self, client, topleft, bottomright):
+        """Move a client's screen, recompute the buffer around it, and save it"""
+        client.position(topleft, bottomright)
+        self.update_buffer()
+        db.update_client(client)
+
+    def metrics(self):
+        """Current state of the server, for flight recorder dumps"""
+        metrics = dict(clients=[c.hostname for c in self.clients], buffer_size=self.buffer_size)
+        if self.profile is not None:
+            metrics['latency_profile'] = self.profile.report()
+        return metrics
+
     def update_buffer(self):
         screen = [0,0,self.screen[0], self.screen[1]]
         for client in self.clients:
@@ -169,7 +413,42 @@ class Server(object):
             screen[2] = max(screen[2], client.xlim[1])
             screen[3] = max(screen[3], client.ylim[1])
         self.buffer_size = screen
-        logger.debug(f'Current screen size: {self.buffer_size}')
+        logger.debug('Current screen size: %s', self.buffer_size)
+        self.update_edges()
+
+    def update_edges(self):
+        """Find the edges of this screen which have a client on the other side"""
+        width, height = self.screen
+        edges = []
+        for client in self.clients:
+            (x0, x1), (y0, y1) = client.xlim, client.ylim
+            if y0 < height and y1 > 0:
+                if x1 <= 0:
+                    edges.append(('left', y0, y1))
+                elif x0 >= width:
+                    edges.append(('right', y0, y1))
+            if x0 < width and x1 > 0:
+                if y1 <= 0:
+                    edges.append(('top', x0, x1))
+                elif y0 >= height:
+                    edges.append(('bottom', x0, x1))
+        self.edges = edges
+
+    def near_edge(self):
+        """Whether the pointer is within edge_margin of an edge leading to a client"""
+        x, y = self.pos
+        m = self.edge_margin
+        width, height = self.screen
+        for side, lo, hi in self.edges:
+            if side in ('left', 'right'):
+                near = x <= m if side == 'left' else x >= width - m
+                if near and lo - m <= y <= hi + m:
+                    return True
+            else:
+                near = y <= m if side == 'top' else y >= height - m
+                if near and lo - m <= x <= hi + m:
+                    return True
+        return False
 
     async def deny_client(self, client, reader, writer):
         #TODO: decide what to store and send when we want to deny this client
@@ -183,8 +462,10 @@ class Server(object):
             self.pos[1] < 0 or 
             self.pos[1] > self.screen[1])
 
-    async def move_x(self, x):
-        x = self.pos[0] + int(x * self.accel)
+    async def move_x(self, dx):
+        x = self.pos[0] + int(dx * self.accel)
+        if self.locked is not None:
+            x = clamp(x, self.locked.xlim[0] + 1, self.locked.xlim[1] - 1)
         if x > self.buffer_size[2]:
             x = self.buffer_size[2]
         elif x < self.buffer_size[0]:
@@ -194,15 +475,20 @@ class Server(object):
         self.pos[0] = x
 
         if self.offscreen:
-            #position gets recomputed by send_event
-            await self.send_event(Event(enums.EV_REL, enums.REL_X, x))
+            #position gets recomputed by send_event, unless the client wants raw deltas
+            await self.send_event(Event(enums.EV_REL, enums.REL_X, dx))
+        elif self.passthrough:
+            #the real cursor isn't exactly at the estimate, move it along instead
+            await self.local(Event(enums.EV_REL, enums.REL_X, dx))
         else:
             x = int(clamp(self.pos[0], 0, self.screen[0]))
-            self.local_event(Event(enums.EV_ABS, enums.ABS_X, x))
+            await self.local(Event(enums.EV_ABS, enums.ABS_X, x))
             #self.local_event(Event(enums.EV_REL, enums.REL_X, dx))
 
-    async def move_y(self, y):
-        y = self.pos[1] + int(y * self.accel)
+    async def move_y(self, dy):
+        y = self.pos[1] + int(dy * self.accel)
+        if self.locked is not None:
+            y = clamp(y, self.locked.ylim[0] + 1, self.locked.ylim[1] - 1)
 
         if y > self.buffer_size[3]:
             y = self.buffer_size[3]
@@ -213,17 +499,38 @@ class Server(object):
         self.pos[1] = y
 
         if self.offscreen:
-            await self.send_event(Event(enums.EV_REL, enums.REL_Y, y))
+            await self.send_event(Event(enums.EV_REL, enums.REL_Y, dy))
+        elif self.passthrough:
+            await self.local(Event(enums.EV_REL, enums.REL_Y, dy))
         else:
             y = int(clamp(self.pos[1], 0, self.screen[1]))
-            self.local_event(Event(enums.EV_ABS, enums.ABS_Y, y))
+            await self.local(Event(enums.EV_ABS, enums.ABS_Y, y))
             #self.local_event(Event(enums.EV_REL, enums.REL_Y, dy))
 
     async def handle_keyboard(self, event):
+        self.recorder.record(EVENT, event.type, event.code, event.value)
+        if self.locked is not None and event.type == enums.EV_KEY and \
+            event.code == self.unlock_key and event.value == 1:
+            self.lock(None)
         if self.offscreen:
             await self.send_event(event)
+        else:
+            if self.mirror:
+                #the keyboard isn't grabbed, so only the mirrored copy is needed
+                await self.mirror_event(event)
+            if event.type == enums.EV_SYN and len(self._unsent) > 0:
+                self.flush_frames()
 
     async def handle_mouse(self, ev):
+        self.recorder.record(EVENT, ev.type, ev.code, ev.value)
+        if not self.mouse_grabbed:
+            await self.track_mouse(ev)
+            return
+
+        scroll = ev.type == enums.EV_REL and (ev.code in self._hires or ev.code in self._lores)
+        if ev.type != enums.SYN_REPORT and not scroll:
+            self._mouse_pending = True
+
         if ev.type == enums.EV_REL:
             #Single move event
             #update the internal cursor tracker
@@ -235,15 +542,18 @@ class Server(object):
             else:
                 #scroll events get funneled here
                 if self.offscreen:
-                    await self.send_event(ev)
+                    if scroll:
+                        self.accumulate_scroll(ev)
+                    else:
+                        await self.send_event(ev)
                 else:
-                    self.local_event(ev)
+                    await self.local(ev)
         elif ev.type == enums.EV_KEY:
             #left, middle, right click events
             if self.offscreen:
                 await self.send_event(ev)
             else:
-                self.local_event(ev)
+                await self.local(ev)
                 
         elif ev.type == enums.SYN_REPORT:
             #detect if we've moved off this screen
@@ -254,17 +564,261 @@ class Server(object):
                 self.grab_keyboard(False)
                 self._last_screen = False
 
+            active = next((c for c in self.clients if self.pos in c), None)
+            if active is not self._active:
+                if self._active is not None:
+                    await self.release_keys(self._active)
+                self._active = active
+                #raw motion is for pointer locked apps, which keep moving one way
+                #for as long as you like, so don't let that carry the pointer out
+                if active is not None and active.relative:
+                    self.lock(active)
+
+            pending, self._mouse_pending = self._mouse_pending, False
             if self.offscreen:
-                await self.send_event(ev)
+                flushed = await self.end_scroll_frame()
+                #a frame that only added to the deferred scroll sends nothing,
+                #the timer flush sends its own SYN_REPORT
+                if pending or flushed or len(self._unsent) > 0:
+                    await self.send_event(ev)
             else:
-                self.local_event(ev)
+                #scroll still pending for a client doesn't follow the pointer back
+                self._scroll_frame.clear()
+                self._scroll_hires.clear()
+                self._scroll_pending.clear()
+                self._scroll_rem.clear()
+                await self.local(ev)
+                if len(self._unsent) > 0:
+                    #the frame started on a client before the pointer came back
+                    self.flush_frames()
+                if self.passthrough and not self.mirror and not self.near_edge():
+                    #back away from the edges, hand the pointer back to the kernel
+                    self.grab_mouse(False)
+                    if not self.mouse_grabbed:
+                        self._pinned = [False, False]
+
+    def accumulate_scroll(self, ev):
+        """Add a scroll event to the current frame, in hi-res units
+
+        Devices with hi-res wheels report the same motion on both axes, so once
+        a frame has hi-res motion for a wheel its low-res events are ignored.
+        """
+        if ev.code in self._lores:
+            axis = self._lores[ev.code]
+            if axis not in self._scroll_hires:
+                self._scroll_hires.add(axis)
+                self._scroll_frame[axis] = 0
+            self._scroll_frame[axis] += ev.value
+        elif ev.code not in self._scroll_hires:
+            self._scroll_frame[ev.code] = self._scroll_frame.get(ev.code, 0) + ev.value * WHEEL_DETENT
+
+    async def end_scroll_frame(self):
+        """Move this frame's scroll into the pending total, and send it if it's time
+
+        Returns whether any scroll was sent.
+        """
+        for axis, units in self._scroll_frame.items():
+            self._scroll_pending[axis] = self._scroll_pending.get(axis, 0) + units
+        self._scroll_frame.clear()
+        self._scroll_hires.clear()
+        if len(self._scroll_pending) == 0:
+            return False
+
+        wait = self._scroll_flushed + self.scroll_interval - time.monotonic()
+        if wait <= 0:
+            await self.flush_scroll()
+            return True
+        if self._scroll_timer is None:
+            #make sure the tail of a burst goes out even if no more events come
+            self._scroll_timer = asyncio.get_running_loop().call_later(wait, self._scroll_timeout)
+        return False
+
+    def _scroll_timeout(self):
+        self._scroll_timer = None
+        async def flush():
+            if self.offscreen and len(self._scroll_pending) > 0:
+                await self.flush_scroll()
+                await self.send_event(Event(enums.EV_SYN, enums.SYN_REPORT, 0))
+        self._scroll_task = asyncio.create_task(flush())
+
+    async def flush_scroll(self):
+        """Send the pending scroll as one hi-res and one low-res event per wheel
+
+        Low-res detents are derived from the running hi-res total, so the two
+        axes can't drift apart, and the remainder waits for the next flush.
+        """
+        if self._scroll_timer is not None:
+            self._scroll_timer.cancel()
+            self._scroll_timer = None
+        self._scroll_flushed = time.monotonic()
+        pending, self._scroll_pending = self._scroll_pending, dict()
+        rel = self.capabilities.get(enums.EV_REL, ())
+        for axis, units in pending.items():
+            if units == 0:
+                continue
+            rem = self._scroll_rem.get(axis, 0) + units
+            detents = int(rem / WHEEL_DETENT)
+            self._scroll_rem[axis] = rem - detents * WHEEL_DETENT
+            if self._hires[axis] in rel:
+                await self.send_event(Event(enums.EV_REL, self._hires[axis], units))
+            if detents != 0:
+                await self.send_event(Event(enums.EV_REL, axis, detents))
+
+    async def track_mouse(self, ev):
+        """Follow the pointer while the kernel is moving it
+
+        The position is only an estimate, since the desktop applies its own
+        acceleration. It's anchored on an axis once it gets clamped at a screen
+        edge, where the real cursor is pinned too. The mouse is grabbed when the
+        pointer is pushed against an edge leading to a client, and nothing is
+        written to the local device, which moves relatively from then on.
+        """
+        if ev.type == enums.EV_REL and ev.code in (enums.REL_X, enums.REL_Y):
+            axis = 0 if ev.code == enums.REL_X else 1
+            pos = self.pos[axis] + int(ev.value * self.accel)
+            self.pos[axis] = clamp(pos, 0, self.screen[axis])
+            self._pinned[axis] = pos != self.pos[axis]
+        elif ev.type == enums.SYN_REPORT and (self.mirror or self.pushed_edge()):
+            #refused while a button is held, so the desktop still sees its release
+            self.grab_mouse()
+
+    def pushed_edge(self):
+        """Whether the pointer is pushed against an edge leading to a client
+
+        Only counts once the estimate was actually clamped there, until then it
+        could be anywhere.
+        """
+        for side, lo, hi in self.edges:
+            axis = 0 if side in ('left', 'right') else 1
+            bound = 0 if side in ('left', 'top') else self.screen[axis]
+            if self._pinned[axis] and self.pos[axis] == bound and lo <= self.pos[1-axis] <= hi:
+                return True
+        return False
+
+    async def local(self, ev):
+        """Deliver an event to this screen, and to the mirrored clients"""
+        self.local_event(ev)
+        if self.mirror:
+            await self.mirror_event(ev)
+
+    def set_relative(self, client, relative=True):
+        """Switch a client between absolute positions and raw relative motion"""
+        client.relative = relative
+        if not relative and self.locked is client:
+            self.lock(None)
+        db.update_client(client)
+        logger.info('Client %s using %s motion', client.hostname, 'relative' if relative else 'absolute')
+
+    def lock(self, client):
+        """Confine the pointer to a relative client, or free it with None
+
+        Pressing unlock_key frees it, until it enters a relative client again.
+        """
+        self.locked = client
+        if client is not None:
+            logger.info('Pointer locked to %s, press scroll lock to release it', client.hostname)
+        else:
+            logger.info('Pointer unlocked')
+
+    def set_mirror(self, clients):
+        """Mirror the local keyboard and pointer to a group of clients"""
+        for client in clients:
+            #precomputed transform from this screen to the client's ABS axes
+            client.mirror_scale = (
+                client.resolution[0] / self.screen[0], 
+                client.resolution[1] / self.screen[1])
+        self.mirror = list(clients)
+        self._frame = []
+        if self.mirror and not self.mouse_grabbed:
+            #mirroring needs to see the local motion
+            self.grab_mouse()
+        logger.info('Mirroring input to %s', [c.hostname for c in self.mirror])
+
+    def toggle_mirror(self, client):
+        group = [c for c in self.mirror if c is not client]
+        if len(group) == len(self.mirror):
+            group.append(client)
+        self.set_mirror(group)
+
+    async def mirror_event(self, ev):
+        self._frame.append(ev)
+        if ev.type == enums.EV_SYN:
+            frame, self._frame = self._frame, []
+            self.broadcast(frame)
+
+    def broadcast(self, events):
+        """Send a frame to every mirrored client, encoding it only once
+
+        Clients with the same ABS scaling share the same patched buffer.
+        Clients that didn't negotiate batching get one json message per event.
+        """
+        def single(ev, scale):
+            value = ev.value
+            if ev.type == enums.EV_ABS:
+                value = int(value * scale[0 if ev.code == enums.ABS_X else 1])
+            buf = json.dumps(dict(type=ev.type, code=ev.code, value=value)).encode()
+            return len(buf).to_bytes(4, 'big') + buf
+
+        #the frame without autorepeats, for clients that synthesize their own
+        stripped = [ev for ev in events if not _is_repeat(ev)]
+        if all(ev.type == enums.EV_SYN for ev in stripped):
+            stripped = None
+
+        encoded = dict()
+        patched = dict()
+        for client in list(self.mirror):
+            if client.writer.is_closing():
+                self.remove_client(client, 'connection closed')
+                continue
+            frame_events = events
+            if client.synth_repeat:
+                if stripped is None:
+                    continue
+                frame_events = stripped
+            if not client.batching:
+                key = None, client.synth_repeat, client.mirror_scale
+                if key not in patched:
+                    patched[key] = b''.join(single(ev, client.mirror_scale) for ev in frame_events)
+                client.writer.write(patched[key])
+                continue
+            ekey = client.binary, client.synth_repeat
+            if ekey not in encoded:
+                encoded[ekey] = _encode_frame(frame_events, client.binary)
+            frame, slots = encoded[ekey]
+            if len(slots) == 0:
+                client.writer.write(frame)
+                continue
+            key = client.binary, client.synth_repeat, client.mirror_scale
+            try:
+                buf = patched[key]
+            except KeyError:
+                buf = bytearray(frame)
+                for offset, code, value in slots:
+                    scale = client.mirror_scale[0 if code == enums.ABS_X else 1]
+                    if client.binary:
+                        struct.pack_into('<i', buf, offset, int(value * scale))
+                    else:
+                        buf[offset:offset+SLOT_WIDTH] = b'%*d' % (SLOT_WIDTH, int(value * scale))
+                patched[key] = buf
+            client.writer.write(buf)
 
     async def send_event(self, ev):
-        for client in self.clients:
+        for client in list(self.clients):
             if self.pos in client:
+                if client.synth_repeat:
+                    #drop autorepeats and scan codes, and the reports left empty by that
+                    if _is_repeat(ev):
+                        continue
+                    elif ev.type == enums.EV_SYN:
+                        if not client.pending:
+                            continue
+                        client.pending = False
+                    else:
+                        client.pending = True
                 evtype, evcode, val = ev.type, ev.code, ev.value
                 #if event is a mouse move, rewrite the position
-                if ev.type == enums.EV_REL:
+                #relative clients get the raw deltas, and apply their own accel
+                if ev.type == enums.EV_REL and not client.relative:
                     if evcode == enums.REL_X:
                         evtype = enums.EV_ABS
                         evcode = enums.ABS_X
@@ -273,40 +827,122 @@ class Server(object):
                         evtype = enums.EV_ABS
                         evcode = enums.ABS_Y
                         val = int((self.pos[1] - client.ylim[0]) * client.move_scale)
-                pkg = dict(type=evtype, code=evcode, value=val)
-                try:
-                    await asyncio.wait_for(_xfer(client.writer, pkg), 2)
-                except asyncio.TimeoutError:
-                    #this client died, remove it!
-                    self.remove_client(client)
+                elif evtype == enums.EV_KEY:
+                    if val == 0:
+                        client.held.discard(evcode)
+                    else:
+                        client.held.add(evcode)
+                await self.deliver(client, evtype, evcode, val)
+        if ev.type == enums.EV_SYN and len(self._unsent) > 0:
+            self.flush_frames()
+
+    async def deliver(self, client, evtype, evcode, val):
+        """Send one event to a client, or add it to the client's frame"""
+        self.recorder.record(SEND, evtype, evcode, val, note=client.hostname)
+        if client.batching:
+            #held until the end of the frame
+            if client.binary:
+                client.frame += EVENT_FORMAT.pack(0, 0, evtype, evcode, val)
+            else:
+                client.events.append((evtype, evcode, val))
+            self._unsent.add(client)
+            return
+        pkg = dict(type=evtype, code=evcode, value=val)
+        try:
+            await asyncio.wait_for(_xfer(client.writer, pkg), 2)
+        except asyncio.TimeoutError:
+            #this client died, remove it!
+            self.remove_client(client, 'send timeout')
+
+    async def release_keys(self, client):
+        """Release whatever is still held on a client the pointer has left
+
+        The key up would otherwise go to wherever the pointer is now, leaving
+        the key stuck down, or repeating forever, on the client.
+        """
+        if client not in self.clients or len(client.held) == 0:
+            return
+        held, client.held = client.held, set()
+        for code in sorted(held):
+            await self.deliver(client, enums.EV_KEY, code, 0)
+        await self.deliver(client, enums.EV_SYN, enums.SYN_REPORT, 0)
+        client.pending = False
+        if len(self._unsent) > 0:
+            self.flush_frames()
+
+    def flush_frames(self):
+        """Write out each pending frame in a single write
+
+        Called on every SYN_REPORT while frames are pending, including ones
+        handled locally, so a client the pointer left in the middle of a frame
+        gets its frame finished with a SYN_REPORT.
+        """
+        unsent, self._unsent = self._unsent, set()
+        for client in unsent:
+            frame, client.frame = client.frame, bytearray()
+            events, client.events = client.events, []
+            if client.writer.is_closing():
+                self.remove_client(client, 'connection closed')
+                continue
+            if client.binary:
+                if not frame.endswith(SYN_EVENT):
+                    frame += SYN_EVENT
+                client.writer.write(_frame_header(len(frame)) + frame)
+            else:
+                if events[-1][0] != enums.EV_SYN:
+                    events.append((enums.EV_SYN, enums.SYN_REPORT, 0))
+                buf = json.dumps(dict(events=events)).encode()
+                client.writer.write(len(buf).to_bytes(4, 'big') + buf)
 
     async def heartbeat(self):
         logger.debug("Running heartbeat loop")
         while self.running:
             #emit a heartbeat every 5 seconds
-            for client in self.clients:
-                await _xfer(client.writer, dict(heartbeat=True))
+            for client in list(self.clients):
+                start = time.monotonic()
                 try:
+                    await _xfer(client.writer, dict(heartbeat=True))
                     resp = await asyncio.wait_for(_recv(client.reader), 2)
                     if not 'alive' in resp:
                         raise asyncio.TimeoutError
-                except (asyncio.TimeoutError, json.decoder.JSONDecodeError):
+                    self.recorder.record(HEARTBEAT, 1, int((time.monotonic() - start) * 1e6), 
+                        note=client.hostname)
+                except (asyncio.TimeoutError, json.decoder.JSONDecodeError, ConnectionError):
                     #client hasn't responded to a heartbeat, remove it
-                    logger.warning(f"Client {client.hostname} failed to respond to heartbeat, removing")
-                    self.remove_client(client)
+                    self.recorder.record(HEARTBEAT, 0, int((time.monotonic() - start) * 1e6), 
+                        note=client.hostname)
+                    logger.warning("Client %s failed to respond to heartbeat, removing", client.hostname)
+                    self.remove_client(client, 'heartbeat')
             await asyncio.sleep(5)
         logger.debug("Exited heartbeat loop")
 
     def stop(self):
         self.running = False
+        if self._scroll_timer is not None:
+            self._scroll_timer.cancel()
         #self.hbtask.cancel()
         self.server_task.cancel()
+        if self.local_task is not None:
+            self.local_task.cancel()
+            try:
+                os.remove(self.local_socket)
+            except OSError:
+                pass
 
 class Client(object):
+    #input encodings this client can handle, fastest first
+    encodings = ('json',)
+    #whether this client can synthesize key repeats itself
+    synth_repeat = False
+
     def __init__(self, hostname=None, token=config['token'], 
-        resolution=None, topleft=None, bottomright=None):
+        resolution=None, topleft=None, bottomright=None, relative=False, app=None):
         self.hostname = hostname
+        self.app = app
         self.resolution = resolution
+        #forward raw relative motion instead of absolute positions
+        self.relative = relative
+        self.last_activity = 0
 
         if hostname is None:
             self.hostname = socket.gethostname()
@@ -330,19 +966,117 @@ class Client(object):
 
         self.move_scale = self.resolution[0] / self.xrange 
 
-    async def connect(self, server, resolution):
+    async def open(self, server):
+        """Open a connection to the server
+
+        Addresses starting with "unix:" go over the unix socket without TLS
+        """
+        if server.startswith('unix:'):
+            return await asyncio.open_unix_connection(server[5:] or SOCKET_PATH)
+        return await asyncio.open_connection(server, PORT, ssl=self.sslctx)
+
+    async def race(self, servers, stagger=0.05, timeout=5):
+        """Connect to several servers at once, keeping the first to finish its handshake
+
+        Attempts start a little apart in the given order, Happy Eyeballs style,
+        so the most recently used server wins a near tie. The rest are cancelled,
+        or closed if they also made it.
+        """
+        async def attempt(i, server):
+            await asyncio.sleep(i * stagger)
+            reader, writer = await asyncio.wait_for(self.open(server), timeout)
+            return server, reader, writer
+
+        pending = set(asyncio.create_task(attempt(i, server)) for i, server in enumerate(servers))
+        winner = None
+        try:
+            while len(pending) > 0 and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logger.debug(f'Connection attempt failed: {task.exception()!r}')
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[2].close()
+        finally:
+            for task in pending:
+                task.cancel()
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, tuple):
+                    result[2].close()
+
+        if winner is None:
+            raise ConnectionError(f'None of {servers} could be reached')
+        return winner
+
+    async def connect(self, server, resolution, caps_cache=None):
+        """Connect to a server, or race a list of servers and keep the fastest
+
+        If the server picks a cached descriptor that turns out to be unreadable,
+        reconnect without offering the cache to get the full capabilities.
+        """
         logger.info(f"Connecting to {server}")
-        reader, writer = await asyncio.open_connection(server, PORT, ssl=self.sslctx)
-        
+        if isinstance(server, (list, tuple)):
+            server, reader, writer = await self.race(server)
+        else:
+            reader, writer = await self.open(server)
+        self.server = server
+
         metadata = dict(hostname=self.hostname, 
             token=self.token, 
-            resolution=resolution)
+            resolution=resolution,
+            version=PROTOCOL_VERSION,
+            features=dict(
+                encodings=list(self.encodings),
+                batching=True,
+                compression=list(COMPRESSION),
+                repeat=self.synth_repeat,
+                caps_cache=cached_caps() if caps_cache is None else caps_cache))
         await _xfer(writer, metadata)
         logger.info(f'Connected to {server}')
 
         self.reader = reader
         self.writer = writer
-        return await self.handle_heartbeat()
+        msg = await self.handle_heartbeat()
+        caps = self.read_caps(msg)
+        if caps is None and caps_cache is None and 'caps_hash' in msg:
+            writer.close()
+            return await self.connect(server, resolution, caps_cache=[])
+        if caps is not None and self.app is not None:
+            self.app.connected(server)
+        return caps
+
+    def read_caps(self, msg):
+        """Get the capabilities from the server's first message
+
+        Capabilities are identified by their hash, and the server only sends
+        the full dict if it isn't in our cache.
+        """
+        #key repeat delay and period, if the server wants us to synthesize repeats
+        self.repeat = msg.get('repeat')
+        #features picked by the server, older servers don't negotiate
+        self.features = msg.get('features', dict(version=1, encoding='json'))
+        logger.debug(f'Negotiated features: {self.features}')
+        if 'caps_hash' not in msg:
+            #older servers send the bare capabilities
+            self.caps_hash = caps_hash(msg)
+            return msg
+
+        self.caps_hash = msg['caps_hash']
+        if 'capabilities_zlib' in msg:
+            msg['capabilities'] = json.loads(zlib.decompress(base64.b64decode(msg['capabilities_zlib'])))
+        if 'capabilities' in msg:
+            save_caps(self.caps_hash, msg['capabilities'])
+            return msg['capabilities']
+        try:
+            return load_caps(self.caps_hash)
+        except (OSError, json.decoder.JSONDecodeError):
+            logger.warning(f'Cached capabilities {self.caps_hash} could not be loaded')
+            try:
+                os.remove(os.path.join(caps_dir, f'{self.caps_hash}.json'))
+            except OSError:
+                pass
 
     async def handle_heartbeat(self):
         """Handle received packets
@@ -352,10 +1086,11 @@ class Client(object):
         heartbeats.
         """
         data = await _recv(self.reader)
-        while "heartbeat" in data:
+        while isinstance(data, dict) and "heartbeat" in data:
             await _xfer(self.writer, dict(alive=True))
             data = await _recv(self.reader)
                 #ignore invalid json
+        self.last_activity = time.monotonic()
         return data
 
     def stop(self):
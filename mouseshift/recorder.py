@@ -0,0 +1,125 @@
+"""Always-on flight recorder
+
+Keeps the most recent input events, sends, heartbeats and client removals in
+a preallocated ring buffer, cheap enough to leave running in the input path.
+The buffer can be dumped to disk after the fact, when somebody reports that
+the cursor froze.
+"""
+import os
+import json
+import time
+import array
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import flight_dir
+
+EVENT, SEND, HEARTBEAT, CONNECT, REMOVE = range(5)
+KINDS = ('event', 'send', 'heartbeat', 'connect', 'remove')
+#number of dumps kept in flight_dir, oldest are removed first
+MAX_DUMPS = 20
+#dumps are written one at a time, so pruning sees every finished file
+_write_lock = threading.Lock()
+
+class FlightRecorder(object):
+    """Ring buffer of timestamped records
+
+    Each record is a kind, three integers and an optional note object. The
+    note is stored by reference and only formatted when the buffer is dumped.
+    """
+    def __init__(self, size=1<<16, min_interval=30):
+        #size is rounded up to a power of two so the slot is a mask away
+        self.size = 1 << max(size - 1, 1).bit_length()
+        self.mask = self.size - 1
+        self.times = array.array('d', bytes(8 * self.size))
+        self.kinds = array.array('B', bytes(self.size))
+        self.values = [array.array('q', bytes(8 * self.size)) for _ in range(3)]
+        self.notes = [None] * self.size
+        self.index = 0
+
+        #automatic dumps are rate limited, so a burst of removals writes one file
+        self.min_interval = min_interval
+        self._last_dump = float('-inf')
+
+    def record(self, kind, a=0, b=0, c=0, note=None):
+        i = self.index & self.mask
+        self.times[i] = time.monotonic()
+        self.kinds[i] = kind
+        self.values[0][i] = a
+        self.values[1][i] = b
+        self.values[2][i] = c
+        self.notes[i] = note
+        self.index += 1
+
+    @property
+    def last(self):
+        """Monotonic time of the latest record"""
+        if self.index == 0:
+            return 0
+        return self.times[(self.index - 1) & self.mask]
+
+    def copy(self):
+        """Copy the raw buffers, cheap enough to do on the input loop"""
+        return (self.index, self.times[:], self.kinds[:], 
+            [v[:] for v in self.values], list(self.notes))
+
+    def records(self, copy):
+        """Unpack a copy of the buffers into records in order, oldest first"""
+        end, times, kinds, (a, b, c), notes = copy
+        count = min(end, self.size)
+        records = []
+        for j in range(end - count, end):
+            i = j & self.mask
+            records.append((times[i], kinds[i], a[i], b[i], c[i], notes[i]))
+        return records
+
+    def snapshot(self):
+        """Copy out the records in order, oldest first"""
+        return self.records(self.copy())
+
+    def dump(self, reason='', auto=False, extra=None):
+        """Write the buffer to a file in the background
+
+        Returns the path of the dump, or None if an automatic dump was skipped
+        because another one happened recently.
+        """
+        now = time.monotonic()
+        if auto and now - self._last_dump < self.min_interval:
+            return None
+        self._last_dump = now
+
+        #only the raw buffers are copied here, the records are built off the loop
+        copy = self.copy()
+        wall = time.time()
+        header = dict(reason=reason, time=wall, records=min(copy[0], self.size))
+        if extra is not None:
+            header.update(extra)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(wall))
+        path = os.path.join(flight_dir, f'flight-{stamp}.{int(wall % 1 * 1e6):06d}.jsonl')
+        thread = threading.Thread(target=self._write, args=(path, header, copy, now))
+        thread.start()
+        return path
+
+    def _write(self, path, header, copy, now):
+        with _write_lock:
+            self._write_dump(path, header, self.records(copy), now)
+
+    def _write_dump(self, path, header, records, now):
+        with open(path, 'wt') as fp:
+            fp.write(json.dumps(header) + '\n')
+            for t, kind, a, b, c, note in records:
+                rec = dict(t=round(t - now, 6), kind=KINDS[kind], a=a, b=b, c=c)
+                if note is not None:
+                    rec['note'] = str(note)
+                fp.write(json.dumps(rec) + '\n')
+        logger.info('Flight recorder dumped to %s', path)
+
+        dumps = sorted(f for f in os.listdir(flight_dir) if f.startswith('flight-'))
+        for old in dumps[:-MAX_DUMPS]:
+            try:
+                os.remove(os.path.join(flight_dir, old))
+            except OSError:
+                #another dump got to it first
+                pass
@@ -0,0 +1,326 @@
+"""Load and soak harness for the Server
+
+Runs a headless Server on loopback and connects hundreds of simulated clients
+to it. The clients speak the real protocol over TLS, and can inject latency,
+stall for a while, or abruptly drop their connection. At the end of the run a
+report is printed with the server CPU and memory growth, the per-client
+delivery latency, and whether the server removed exactly the clients it should
+have.
+
+    python -m mouseshift.soak --clients 300 --duration 3600
+"""
+import os
+import ssl
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import ClientDB, Event, enums, config_dir
+from . import net, recorder
+from .latency import LatencyProfile, percentile
+
+#heartbeats go out every 5 seconds with a 2 second timeout, but the loop is
+#serial over all the clients so allow some slack before calling a removal missed
+REMOVAL_GRACE = 30
+#a client which hears nothing, not even a heartbeat, for this long reconnects
+SILENCE_TIMEOUT = 15
+PROBE_WRAP = 1 << 31
+
+def _now_us():
+    #wrapped to fit the 32 bit value of an input_event
+    return (time.monotonic_ns() // 1000) % PROBE_WRAP
+
+def _rss():
+    """Resident set size of this process in bytes"""
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize()
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class SoakServer(net.Server):
+    """Headless server without any input devices
+
+    Keeps a log of every client removal so it can be checked against what the
+    simulated clients actually did.
+    """
+    def __init__(self, **kwargs):
+        self.capabilities = {
+            enums.EV_KEY: list(range(1, 249)) + [enums.BTN_LEFT, enums.BTN_RIGHT, enums.BTN_MIDDLE],
+            enums.EV_REL: [enums.REL_WHEEL, enums.REL_HWHEEL],
+            enums.EV_MSC: [enums.MSC_SCAN],
+        }
+        super(SoakServer, self).__init__((1920, 1080), **kwargs)
+        self.removals = []
+
+    def grab_keyboard(self, grabbed=True):
+        pass
+
+    def local_event(self, event):
+        pass
+
+    def remove_client(self, client, reason=''):
+        if client in self.clients:
+            self.removals.append((time.monotonic(), client.hostname))
+        super(SoakServer, self).remove_client(client, reason)
+
+class SimClient(net.Client):
+    """Simulated client which misbehaves on a schedule
+
+    Latency is injected before every message is handled. Stalls and drops
+    happen at exponentially distributed intervals with the given means.
+    """
+    encodings = ('evbin', 'json')
+
+    def __init__(self, index, sslctx, args):
+        super(SimClient, self).__init__(
+            hostname=f'soak-{index:04d}',
+            token='soak',
+            resolution=(1920, 1080))
+        self.sslctx = sslctx
+        self.args = args
+        self.rng = random.Random(args.seed + index)
+        self.latencies = []
+        self.drops = []
+        self.stalls = []
+        self.errors = 0
+        self.orphaned = 0
+
+    def _next(self, mean):
+        if mean <= 0:
+            return float('inf')
+        return time.monotonic() + self.rng.expovariate(1 / mean)
+
+    async def run(self, server, until):
+        while time.monotonic() < until:
+            try:
+                await self.connect(server, self.resolution)
+                await self.receive(until)
+            except asyncio.TimeoutError:
+                #server stopped talking to us without closing the connection
+                self.orphaned += 1
+                self.writer.close()
+            except (OSError, ssl.SSLError, json.decoder.JSONDecodeError):
+                self.errors += 1
+            await asyncio.sleep(self.rng.uniform(0.5, 2))
+
+    async def receive(self, until):
+        next_drop = self._next(self.args.drop_every)
+        next_stall = self._next(self.args.stall_every)
+        while time.monotonic() < until:
+            timeout = min(SILENCE_TIMEOUT, max(until - time.monotonic(), 0.1))
+            data = await asyncio.wait_for(net._recv(self.reader), timeout)
+            now = time.monotonic()
+            if now >= next_drop:
+                self.writer.transport.abort()
+                self.drops.append(now)
+                return
+            if now >= next_stall:
+                await asyncio.sleep(self.args.stall_time)
+                self.stalls.append((now, time.monotonic()))
+                next_stall = self._next(self.args.stall_every)
+            if self.args.latency > 0:
+                await asyncio.sleep(self.rng.uniform(0, 2 * self.args.latency))
+
+            if isinstance(data, bytes):
+                for _, _, evtype, code, value in net.EVENT_FORMAT.iter_unpack(data):
+                    if evtype == enums.EV_MSC:
+                        self.probe(value)
+            elif 'heartbeat' in data:
+                await net._xfer(self.writer, dict(alive=True))
+            elif data.get('type') == enums.EV_MSC:
+                self.probe(data['value'])
+
+    def probe(self, sent):
+        self.latencies.append((_now_us() - sent) % PROBE_WRAP)
+
+    def report(self):
+        return dict(
+            hostname=self.hostname,
+            latencies=self.latencies,
+            drops=self.drops,
+            stalls=self.stalls,
+            errors=self.errors,
+            orphaned=self.orphaned)
+
+def _worker(indices, args, certpath, caps_dir, until, queue):
+    """Runs a share of the simulated clients in a separate process"""
+    #spawned processes import net afresh, so redirect the cache again
+    net.caps_dir = caps_dir
+
+    async def main():
+        sslctx = ssl.create_default_context(cafile=certpath)
+        #the server cert is issued to its hostname, not to the loopback address
+        sslctx.check_hostname = False
+        clients = [SimClient(i, sslctx, args) for i in indices]
+        await asyncio.gather(*[client.run('127.0.0.1', until) for client in clients])
+        return clients
+
+    clients = asyncio.run(main())
+    queue.put([client.report() for client in clients])
+
+async def drive(server, rate, until):
+    """Push probe events at whichever client the cursor is moved into
+
+    Each probe carries its send time so the client can measure delivery latency.
+    """
+    interval = 1 / rate
+    while time.monotonic() < until:
+        if len(server.clients) > 0:
+            client = random.choice(server.clients)
+            server.pos[0] = (client.xlim[0] + client.xlim[1]) // 2
+            server.pos[1] = (client.ylim[0] + client.ylim[1]) // 2
+            await server.move_x(0)
+            await server.send_event(Event(enums.EV_MSC, enums.MSC_SCAN, _now_us()))
+            await server.send_event(Event(enums.EV_SYN, enums.SYN_REPORT, 0))
+        await asyncio.sleep(interval)
+
+async def sample(samples, until, interval=1):
+    while time.monotonic() < until:
+        samples.append((time.monotonic(), _cpu(), _rss()))
+        await asyncio.sleep(interval)
+
+def check_removals(removals, clients, start, until):
+    """Match every removal to a drop or stall, and every drop to a removal"""
+    removed = {}
+    for t, hostname in removals:
+        removed.setdefault(hostname, []).append(t)
+
+    unexpected, missed = [], []
+    for client in clients:
+        times = removed.get(client['hostname'], [])
+        for t in times:
+            if t > until:
+                #clients disconnect when the run ends
+                continue
+            caused = any(t - REMOVAL_GRACE <= d <= t for d in client['drops']) or \
+                any(s <= t <= e + REMOVAL_GRACE for s, e in client['stalls'])
+            if not caused:
+                unexpected.append((client['hostname'], round(t - start, 3)))
+        for d in client['drops']:
+            if d + REMOVAL_GRACE > until:
+                continue
+            if not any(d <= t <= d + REMOVAL_GRACE for t in times):
+                missed.append((client['hostname'], round(d - start, 3)))
+    return unexpected, missed
+
+async def soak(args, profile=None):
+    server = SoakServer()
+    await server.serve()
+    if profile is not None:
+        server.profile = profile
+        profile.started()
+        asyncio.create_task(profile.collect_when_idle(lambda: server.recorder.last))
+    certpath = os.path.join(config_dir, f'{server.name}.crt')
+
+    start = time.monotonic()
+    until = start + args.duration
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    workers = []
+    for w in range(args.workers):
+        indices = list(range(w, args.clients, args.workers))
+        proc = ctx.Process(target=_worker, args=(indices, args, certpath, net.caps_dir, until, queue))
+        proc.start()
+        workers.append(proc)
+
+    samples = []
+    await asyncio.gather(
+        drive(server, args.rate, until),
+        sample(samples, until + REMOVAL_GRACE))
+
+    loop = asyncio.get_running_loop()
+    clients = []
+    for proc in workers:
+        clients.extend(await loop.run_in_executor(None, queue.get))
+        proc.join()
+    server.stop()
+
+    latencies = [lat / 1000 for client in clients for lat in client['latencies']]
+    client_p99 = [percentile(client['latencies'], 99) / 1000
+        for client in clients if len(client['latencies']) > 0]
+    unexpected, missed = check_removals(server.removals, clients, start, until)
+
+    (t0, cpu0, rss0), (t1, cpu1, rss1) = samples[0], samples[-1]
+    return dict(
+        clients=args.clients,
+        duration=args.duration,
+        server=dict(
+            cpu_seconds=cpu1 - cpu0,
+            cpu_percent=100 * (cpu1 - cpu0) / (t1 - t0),
+            rss_start=rss0,
+            rss_end=rss1,
+            rss_peak=max(s[2] for s in samples),
+            rss_growth_per_hour=(rss1 - rss0) / (t1 - t0) * 3600),
+        latency_ms=dict(
+            count=len(latencies),
+            p50=percentile(latencies, 50),
+            p99=percentile(latencies, 99),
+            max=max(latencies, default=None),
+            worst_client_p99=max(client_p99, default=None)),
+        removals=dict(
+            total=len(server.removals),
+            drops=sum(len(client['drops']) for client in clients),
+            stalls=sum(len(client['stalls']) for client in clients),
+            unexpected=unexpected,
+            missed=missed),
+        client_errors=sum(client['errors'] for client in clients),
+        client_orphaned=sum(client['orphaned'] for client in clients),
+        latency_profile=None if profile is None else profile.report(),
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test the pymouseshift server with simulated clients")
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+        help="Number of processes running simulated clients")
+    parser.add_argument('--duration', type=float, default=600, help="Seconds to run for")
+    parser.add_argument('--rate', type=float, default=500, help="Probe events per second")
+    parser.add_argument('--latency', type=float, default=0.002,
+        help="Mean injected latency per message, in seconds")
+    parser.add_argument('--stall-every', type=float, default=600,
+        help="Mean seconds between stalls for each client, 0 to disable")
+    parser.add_argument('--stall-time', type=float, default=3,
+        help="Length of each stall in seconds")
+    parser.add_argument('--drop-every', type=float, default=900,
+        help="Mean seconds between abrupt disconnects for each client, 0 to disable")
+    parser.add_argument('--latency-profile', action='store_true',
+        help="Run the server with the low latency runtime profile")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+
+    #keep the simulated clients out of the real client database, capabilities
+    #cache and flight recorder dumps
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbpath = os.path.join(tmpdir, 'client_db.json')
+        json.dump({}, open(dbpath, 'w'))
+        net.db = ClientDB(dbpath)
+        net.caps_dir = os.path.join(tmpdir, 'capabilities')
+        recorder.flight_dir = os.path.join(tmpdir, 'flight')
+        os.makedirs(net.caps_dir)
+        os.makedirs(recorder.flight_dir)
+        if args.latency_profile:
+            profile = LatencyProfile()
+            loop = profile.new_event_loop()
+            profile.tune_thread()
+            try:
+                report = loop.run_until_complete(soak(args, profile))
+            finally:
+                loop.close()
+        else:
+            report = asyncio.run(soak(args))
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
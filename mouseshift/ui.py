@@ -7,28 +7,88 @@ logger = logging.getLogger(__name__)
 
 import asyncio
 
+import cairo
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gdk
-
-from . import db
+from gi.repository import Gtk, Gdk, GLib
+
+
+#distance in canvas pixels at which screen edges snap together
+SNAP = 8
+#size of the resize handle in the bottom right corner of client screens
+HANDLE = 14
+
+class SpatialIndex(object):
+    """Uniform grid of the screens on the arrangement canvas
+
+    Collision and snapping only need to look at the screens sharing a cell
+    with the one being dragged, instead of every screen.
+    """
+    def __init__(self, cell=128):
+        self.cell = cell
+        self.cells = dict()
+        self.rects = dict()
+
+    def _keys(self, x, y, width, height):
+        c = self.cell
+        for i in range(int(x // c), int((x + width) // c) + 1):
+            for j in range(int(y // c), int((y + height) // c) + 1):
+                yield i, j
+
+    def insert(self, item, rect):
+        self.remove(item)
+        self.rects[item] = rect
+        for key in self._keys(*rect):
+            self.cells.setdefault(key, set()).add(item)
+
+    def remove(self, item):
+        rect = self.rects.pop(item, None)
+        if rect is None:
+            return
+        for key in self._keys(*rect):
+            cell = self.cells[key]
+            cell.discard(item)
+            if len(cell) == 0:
+                del self.cells[key]
+
+    def query(self, x, y, width, height):
+        found = set()
+        for key in self._keys(x, y, width, height):
+            found.update(self.cells.get(key, ()))
+        return found
 
 class ServerPrefs(Gtk.Window):
+    """Screen arrangement window
+
+    All the screens are drawn with cairo on a single canvas. Drags only record
+    the latest pointer position, which gets applied once per frame. The window
+    is hidden rather than destroyed when closed, so the app can keep reusing it.
+    """
     def __init__(self, app, mainwidth=300):
         self.app = app
         self.resolution = Gdk.Screen.width(), Gdk.Screen.height()
         self.hostname = socket.gethostname()
         super(ServerPrefs, self).__init__(title="pymouseshift Screen Arrangement")
         self.set_size_request(width=1024, height=768)
-
-        self.fixed = Gtk.Fixed()
-        self.add(self.fixed)
+        self.connect('delete-event', self.close)
+
+        self.canvas = Gtk.DrawingArea()
+        self.canvas.add_events(
+            Gdk.EventMask.BUTTON_PRESS_MASK | 
+            Gdk.EventMask.BUTTON_RELEASE_MASK | 
+            Gdk.EventMask.POINTER_MOTION_MASK)
+        self.canvas.connect('draw', self.draw)
+        self.canvas.connect('button-press-event', self.button_down)
+        self.canvas.connect('button-release-event', self.button_up)
+        self.canvas.connect('motion-notify-event', self.motion)
+        self.add(self.canvas)
 
         aspect = self.resolution[0] / self.resolution[1]
         mheight = mainwidth / aspect
         self.origin = (512-mainwidth/2, 384-mheight/2)
+        self.offset = (0, 0)
 
-        self.main = ServerScreen(self, 
+        self.main = ServerScreen(
             self.hostname, 
             '{}x{}'.format(*self.resolution),
             width=mainwidth,
@@ -38,26 +98,60 @@ class ServerPrefs(Gtk.Window):
         self._scale = mainwidth / self.resolution[0] 
 
         self.screens = {self.main:None}
-        self.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
+        self.index = SpatialIndex()
+        self.index.insert(self.main, self.main.rect)
+
+        self._drag = None
+        self._pointer = None
+        self._tick = None
         self.show_all()
 
+    def close(self, window, event):
+        self.hide()
+        return True
+
     def add_client(self, client):
         #rescale position to the visible area
         position = client.xlim[0]*self._scale, client.ylim[0]*self._scale
         width = client.xrange * self._scale
         aspect = client.xrange / client.yrange
 
+        #a reconnecting client replaces its old screen
+        for screen, old in list(self.screens.items()):
+            if old is not None and (old.hostname, old.token) == (client.hostname, client.token):
+                self.remove(screen)
+
         subtext = ''
         if client.resolution is not None:
             subtext = f'{client.resolution[0]}x{client.resolution[1]}'
 
-        screen = ServerScreen(self, client.hostname, 
+        screen = ServerScreen(client.hostname, 
             subtext, 
             position=position, 
             width=width, 
             aspect=aspect)
-        self.show_all()
+        logger.debug(f'Adding host {client.hostname} at ({position[0]}, {position[1]})')
         self.screens[screen] = client
+        self.index.insert(screen, screen.rect)
+        self.canvas.queue_draw()
+
+    def rm_client(self, client):
+        for screen, old in list(self.screens.items()):
+            if old is client:
+                self.remove(screen)
+        self.canvas.queue_draw()
+
+    def clear(self):
+        for screen in list(self.screens.keys()):
+            if screen is not self.main:
+                self.remove(screen)
+        self.canvas.queue_draw()
+
+    def remove(self, screen):
+        del self.screens[screen]
+        self.index.remove(screen)
+        if self._drag is not None and self._drag[0] is screen:
+            self._drag = None
 
     def update(self, screen, position, width):
         x = int(position[0] / self._scale)
@@ -66,151 +160,191 @@ class ServerPrefs(Gtk.Window):
         height = width / screen.aspect
         logger.info(f'Updating screen {screen.name} to ({x},{y}), width {width}')
 
+        #the layout and the client db belong to the server loop, so hand the
+        #change over, it gets saved there once applied
         client = self.screens[screen]
-        client.position((x, y), (x+width, y+height))
-        self.app.server.update_buffer()
-        db.update_client(client)    
+        self.app.call(self.app.server.move_client, client, (x, y), (x+width, y+height))
 
-    def put(self, client):
-        x = client.position[0] + self.origin[0]
-        y = client.position[1] + self.origin[1]
-        self.fixed.put(client, x, y)
+    def draw(self, widget, cr):
+        cr.set_source_rgb(0.85, 0.85, 0.85)
+        cr.paint()
+        ox = self.origin[0] + self.offset[0]
+        oy = self.origin[1] + self.offset[1]
+        for screen in self.screens.keys():
+            screen.draw(cr, ox, oy, screen is self.main)
 
-    def move(self, client, x, y):
-        self.fixed.move(client, x+self.origin[0], y+self.origin[1])
+    def _canvas_pos(self, event):
+        x = event.x - self.origin[0] - self.offset[0]
+        y = event.y - self.origin[1] - self.offset[1]
+        return x, y
 
-    def collide_position(self, client, x, y):
-        for screen in self.screens.keys():
-            if screen != client:
-                top, right, bottom, left = screen.collide((x, y), client.width, client.height)
-                m = max(top, max(right, max(bottom, left)))
-                if m == top and top < 0:
-                    y += top
-                elif m == right and right < 0:
-                    x -= right
-                elif m == bottom and bottom < 0:
-                    y -= bottom
-                elif m == left and left < 0:
-                    x += left
+    def button_down(self, widget, event):
+        x, y = self._canvas_pos(event)
+        near = self.index.query(x, y, 0, 0)
+        #later screens are drawn on top, so hit test them first
+        for screen in reversed([s for s in self.screens.keys() if s in near]):
+            mode = screen.hit(x, y)
+            if mode is not None:
+                if screen is self.main:
+                    mode = 'pan'
+                self._drag = screen, mode, (event.x, event.y), screen.position, screen.width, self.offset
+                return True
+        return False
+
+    def motion(self, widget, event):
+        if self._drag is None:
+            return False
+        #only keep the latest position, it gets applied on the next frame
+        self._pointer = event.x, event.y
+        if self._tick is None:
+            self._tick = self.canvas.add_tick_callback(self._frame)
+        return True
+
+    def _frame(self, widget, clock):
+        self._tick = None
+        if self._drag is not None and self._pointer is not None:
+            self.apply_drag(*self._pointer)
+            self.canvas.queue_draw()
+        return GLib.SOURCE_REMOVE
+
+    def button_up(self, widget, event):
+        if self._drag is None:
+            return False
+        if self._tick is not None:
+            self.canvas.remove_tick_callback(self._tick)
+            self._tick = None
+        self.apply_drag(event.x, event.y)
+        screen, mode = self._drag[:2]
+        self._drag, self._pointer = None, None
+        if mode != 'pan':
+            self.update(screen, screen.position, screen.width)
+        self.canvas.queue_draw()
+        return True
+
+    def apply_drag(self, px, py):
+        screen, mode, start, position, width, offset = self._drag
+        dx, dy = px - start[0], py - start[1]
+        if mode == 'pan':
+            self.offset = offset[0] + dx, offset[1] + dy
+            return
+        elif mode == 'body':
+            screen.position = self.collide_position(screen, position[0] + dx, position[1] + dy)
+        elif mode == 'corner':
+            width = width + dx
+            screen.width, _ = self.collide_width(screen, width, width / screen.aspect)
+        self.index.insert(screen, screen.rect)
+
+    def _neighbors(self, client, x, y, width, height):
+        near = self.index.query(x - SNAP, y - SNAP, width + 2*SNAP, height + 2*SNAP)
+        near.discard(client)
+        return near
 
+    def collide_position(self, client, x, y):
+        for screen in self._neighbors(client, x, y, client.width, client.height):
+            top, right, bottom, left = screen.collide((x, y), client.width, client.height)
+            m = max(top, max(right, max(bottom, left)))
+            if m == top and top < 0:
+                y += top
+            elif m == right and right < 0:
+                x -= right
+            elif m == bottom and bottom < 0:
+                y -= bottom
+            elif m == left and left < 0:
+                x += left
+
+        return self.snap(client, x, y)
+
+    def snap(self, client, x, y):
+        """Snap edges that are within SNAP pixels of a neighboring screen's edges"""
+        width, height = client.width, client.height
+        for screen in self._neighbors(client, x, y, width, height):
+            sx, sy, swidth, sheight = screen.rect
+            for edge, target in ((x, sx + swidth), (x + width, sx), (x, sx), (x + width, sx + swidth)):
+                if abs(edge - target) < SNAP:
+                    x += target - edge
+                    break
+            for edge, target in ((y, sy + sheight), (y + height, sy), (y, sy), (y + height, sy + sheight)):
+                if abs(edge - target) < SNAP:
+                    y += target - edge
+                    break
         return x, y
 
     def collide_width(self, client, width, height):
-        for screen in self.screens.keys():
-            if screen != client:
-                top, right, bottom, left = screen.collide(client.position, width, height)
-                m = max(top, max(right, max(bottom, left)))
-                if m == top and top < 0:
-                    height += top
-                    width = height * client.aspect
-                elif m == right and right < 0:
-                    width -= right
-                    height = width / client.aspect
-                elif m == bottom and bottom < 0:
-                    height -= bottom
-                    width = height * client.aspect
-                elif m == left and left < 0:
-                    width += left
-                    height = width / client.aspect
+        x, y = client.position
+        for screen in self._neighbors(client, x, y, width, height):
+            top, right, bottom, left = screen.collide(client.position, width, height)
+            m = max(top, max(right, max(bottom, left)))
+            if m == top and top < 0:
+                height += top
+                width = height * client.aspect
+            elif m == right and right < 0:
+                width -= right
+                height = width / client.aspect
+            elif m == bottom and bottom < 0:
+                height -= bottom
+                width = height * client.aspect
+            elif m == left and left < 0:
+                width += left
+                height = width / client.aspect
 
         return width, height
 
-    def pan(self, x, y):
-        pass
-        
-
-class ServerScreen(Gtk.Fixed):
-    GtkIconTheme = Gtk.IconTheme.get_default()
-    def __init__(self, server, name, subtext, position=(0,0), width=384, aspect=1.5, resizeable=True):
-        super(ServerScreen, self).__init__()
-        self.server = server
+class ServerScreen(object):
+    """A screen on the arrangement canvas, in canvas coordinates relative to the server screen"""
+    def __init__(self, name, subtext, position=(0,0), width=384, aspect=1.5, resizeable=True):
         self.position = position
         self.width = width
         self.aspect = aspect
         self.name = name
-
-        self.screen = Gtk.Button()
-        self.screen.set_size_request(self.width, self.height)
-        self.put(self.screen, 0, 0)
-
-        vbox = Gtk.VBox()
-        name_label = Gtk.Label()
-        name_label.set_markup(f"<b>{name}</b>")
-        res_label = Gtk.Label(label=subtext)
-        vbox.add(name_label)
-        vbox.add(res_label)
-        self.screen.add(vbox)
-
-        #always connect the mouse button down to 
-        self.screen.connect('button-press-event', self.button_down)
-        if resizeable:
-            self.screen.connect('button-release-event', self.finalize_position)
-            self.screen.connect('motion-notify-event', self.drag)
-
-            self.corner = Gtk.Button()
-            self.corner.set_size_request(20, 20)
-            self.put(self.corner, self.width-10, self.height-10)
-            self.corner.connect('button-press-event', self.button_down)
-            self.corner.connect('button-release-event', self.finalize_corner)
-            self.corner.connect('motion-notify-event', self.drag_corner)
-            self.corner.set_tooltip_markup(f'Resize client {self.name}')
-
-            del_icon = self.GtkIconTheme.load_icon("list-remove", 16, 0)
-            del_icon = Gtk.Image.new_from_pixbuf(del_icon)
-            self.delbtn = Gtk.Button(image=del_icon)
-            self.delbtn.set_tooltip_markup(f"Delete client {self.name}")
-            self.put(self.delbtn, -12, -12)
-
-            disconn_icon = self.GtkIconTheme.load_icon("window-close", 16, 0)
-            disconn_icon = Gtk.Image.new_from_pixbuf(disconn_icon)
-            self.disconnect = Gtk.Button(image=disconn_icon)
-            self.disconnect.set_size_request(24, 24)
-            self.disconnect.set_tooltip_markup(f"Disconnect client {self.name}")
-            self.put(self.disconnect, self.width-12, -12)
-        else:
-            self.screen.connect('motion-notify-event', self.pan_server)
-
-        logger.debug(f'Adding host {name} at ({self.position[0]}, {self.position[1]})')
-        self.server.put(self)
+        self.subtext = subtext
+        self.resizeable = resizeable
 
     @property
     def height(self):
         return self.width / self.aspect
 
-    def button_down(self, button, event):
-        self._start = event.x_root, event.y_root
-
-    def drag(self, widget, event):
-        x = self.position[0] + event.x_root - self._start[0]
-        y = self.position[1] + event.y_root - self._start[1]
-        x, y = self.server.collide_position(self, x, y)
-        self.server.move(self, x, y)
-
-    def finalize_position(self, button, event):
-        x = self.position[0] + event.x_root - self._start[0]
-        y = self.position[1] + event.y_root - self._start[1]
-        self.position = self.server.collide_position(self, x, y)
-        self.server.update(self, self.position, self.width)
-
-    def drag_corner(self, widget, event):
-        width = self.width + event.x_root - self._start[0]
-        height = width / self.aspect
-        width, height = self.server.collide_width(self, width, height)
-        self.screen.set_size_request(width, height)
-        self.move(self.corner, width-10, height-10)
-        self.move(self.disconnect, width-12, -12)
-
-    def finalize_corner(self, button, event):
-        width = self.width + event.x_root - self._start[0]
-        height = width / self.aspect
-        width, height = self.server.collide_width(self, width, height)
-        self.width = width
-        self.server.update(self, self.position, self.width)
-
-    def pan_server(self, widget, event):
-        x = event.x_root - self._start[0]
-        y = event.y_root - self._start[1]
-        self.server.pan(x, y)
+    @property
+    def rect(self):
+        return self.position[0], self.position[1], self.width, self.height
+
+    def hit(self, x, y):
+        """Which part of the screen is at (x, y): 'corner', 'body' or None"""
+        left, top = self.position
+        right, bottom = left + self.width, top + self.height
+        if self.resizeable and right - HANDLE <= x <= right and bottom - HANDLE <= y <= bottom:
+            return 'corner'
+        elif left <= x <= right and top <= y <= bottom:
+            return 'body'
+
+    def draw(self, cr, ox, oy, main=False):
+        x, y, width, height = self.rect
+        x, y = x + ox, y + oy
+        cr.rectangle(x, y, width, height)
+        if main:
+            cr.set_source_rgb(0.55, 0.65, 0.8)
+        else:
+            cr.set_source_rgb(0.95, 0.95, 0.95)
+        cr.fill_preserve()
+        cr.set_source_rgb(0.2, 0.2, 0.2)
+        cr.set_line_width(1)
+        cr.stroke()
+
+        cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+        cr.set_font_size(14)
+        ext = cr.text_extents(self.name)
+        cr.move_to(x + (width - ext.width) / 2, y + height / 2)
+        cr.show_text(self.name)
+
+        cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        cr.set_font_size(11)
+        ext = cr.text_extents(self.subtext)
+        cr.move_to(x + (width - ext.width) / 2, y + height / 2 + 16)
+        cr.show_text(self.subtext)
+
+        if self.resizeable:
+            cr.rectangle(x + width - HANDLE, y + height - HANDLE, HANDLE, HANDLE)
+            cr.set_source_rgb(0.5, 0.5, 0.5)
+            cr.fill()
 
     def collide(self, position, width, height):
         left = self.position[0] - (position[0] + width)
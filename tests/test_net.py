@@ -0,0 +1,186 @@
+import json
+import time
+import struct
+import types
+import asyncio
+
+import pytest
+for _mod in ('appdirs', 'evdev', 'OpenSSL', 'gi'):
+    pytest.importorskip(_mod)
+
+from mouseshift import Event, enums, net
+
+class Writer(object):
+    def __init__(self):
+        self.buf = bytearray()
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.buf += data
+
+def messages(buf):
+    """Split a written stream back into json dicts and binary frames"""
+    msgs = []
+    while len(buf) > 0:
+        nbytes = int.from_bytes(buf[:4], 'big')
+        if nbytes & net.BINARY_FRAME:
+            nbytes &= ~net.BINARY_FRAME
+            msgs.append([e[2:] for e in net.EVENT_FORMAT.iter_unpack(bytes(buf[4:4+nbytes]))])
+        else:
+            msgs.append(json.loads(bytes(buf[4:4+nbytes])))
+        buf = buf[4+nbytes:]
+    return msgs
+
+FRAME = [
+    Event(enums.EV_ABS, enums.ABS_X, 518),
+    Event(enums.EV_KEY, enums.KEY_A, 1),
+    Event(enums.EV_ABS, enums.ABS_Y, 7),
+    Event(enums.EV_SYN, enums.SYN_REPORT, 0),
+]
+DOUBLED = [
+    [enums.EV_ABS, enums.ABS_X, 1036],
+    [enums.EV_KEY, enums.KEY_A, 1],
+    [enums.EV_ABS, enums.ABS_Y, 14],
+    [enums.EV_SYN, enums.SYN_REPORT, 0],
+]
+
+def test_encode_frame_json_slots():
+    buf, slots = net._encode_frame(FRAME)
+    assert [(code, value) for _, code, value in slots] == [(enums.ABS_X, 518), (enums.ABS_Y, 7)]
+    buf = bytearray(buf)
+    for offset, code, value in slots:
+        buf[offset:offset+net.SLOT_WIDTH] = b'%*d' % (net.SLOT_WIDTH, value * 2)
+    assert messages(buf) == [dict(events=DOUBLED)]
+
+def test_encode_frame_binary_slots():
+    buf, slots = net._encode_frame(FRAME, binary=True)
+    assert [(code, value) for _, code, value in slots] == [(enums.ABS_X, 518), (enums.ABS_Y, 7)]
+    buf = bytearray(buf)
+    for offset, code, value in slots:
+        struct.pack_into('<i', buf, offset, value * 2)
+    assert messages(buf) == [[tuple(ev) for ev in DOUBLED]]
+
+def test_broadcast_scales_every_encoding():
+    server = net.Server.__new__(net.Server)
+    clients = [types.SimpleNamespace(writer=Writer(), binary=binary, batching=batching,
+        synth_repeat=False, mirror_scale=(2, 2))
+        for binary, batching in ((True, True), (False, True), (False, False))]
+    server.mirror = clients
+    server.broadcast(FRAME)
+
+    evbin, batched, single = [messages(c.writer.buf) for c in clients]
+    assert evbin == [[tuple(ev) for ev in DOUBLED]]
+    assert batched == [dict(events=DOUBLED)]
+    assert single == [dict(type=t, code=c, value=v) for t, c, v in DOUBLED]
+
+def test_broadcast_strips_repeats():
+    server = net.Server.__new__(net.Server)
+    client = types.SimpleNamespace(writer=Writer(), binary=False, batching=True,
+        synth_repeat=True, mirror_scale=(1, 1))
+    server.mirror = [client]
+    server.broadcast([
+        Event(enums.EV_MSC, enums.MSC_SCAN, 30),
+        Event(enums.EV_KEY, enums.KEY_A, 2),
+        Event(enums.EV_SYN, enums.SYN_REPORT, 0)])
+    assert len(client.writer.buf) == 0
+
+def negotiator(client_repeat=False):
+    server = net.Server.__new__(net.Server)
+    server.client_repeat = client_repeat
+    return server
+
+def test_negotiate_version_1_fallback():
+    features = negotiator(client_repeat=True).negotiate(1, None)
+    assert features == dict(version=1, encoding='json', batching=False, compression=None,
+        repeat=False, caps_cache=[])
+
+def test_negotiate_picks_fastest_common_features():
+    offered = dict(encodings=['json', 'evbin'], compression=['zlib'], batching=False,
+        caps_cache=['abc'])
+    features = negotiator().negotiate(2, offered)
+    assert features == dict(version=2, encoding='evbin', batching=True, compression='zlib',
+        repeat=False, caps_cache=['abc'])
+
+def test_negotiate_json_only_client():
+    features = negotiator().negotiate(3, dict(encodings=['json'], batching=True))
+    assert features['version'] == net.PROTOCOL_VERSION
+    assert features['encoding'] == 'json'
+    assert features['batching'] is True
+    assert features['compression'] is None
+
+def test_negotiate_repeat_needs_both_sides():
+    assert negotiator(client_repeat=True).negotiate(2, dict(repeat=True))['repeat'] is True
+    assert negotiator(client_repeat=True).negotiate(2, dict())['repeat'] is False
+    assert negotiator(client_repeat=False).negotiate(2, dict(repeat=True))['repeat'] is False
+
+HI, LO = enums.REL_WHEEL_HI_RES, enums.REL_WHEEL
+
+def scroller(hires=True):
+    """Server with only the scroll coalescing state, recording what it sends"""
+    server = net.Server.__new__(net.Server)
+    rel = [enums.REL_WHEEL, enums.REL_HWHEEL]
+    if hires:
+        rel += [enums.REL_WHEEL_HI_RES, enums.REL_HWHEEL_HI_RES]
+    server.capabilities = {enums.EV_REL: rel}
+    server._hires = {enums.REL_WHEEL: enums.REL_WHEEL_HI_RES, enums.REL_HWHEEL: enums.REL_HWHEEL_HI_RES}
+    server._lores = dict((v, k) for k, v in server._hires.items())
+    server._scroll_frame = dict()
+    server._scroll_hires = set()
+    server._scroll_pending = dict()
+    server._scroll_rem = dict()
+    server._scroll_timer = None
+    #defer every frame, the tests flush by hand
+    server.scroll_interval = 3600
+    server._scroll_flushed = time.monotonic()
+    server.sent = []
+    async def send_event(ev):
+        server.sent.append((ev.code, ev.value))
+    server.send_event = send_event
+    return server
+
+async def scroll(server, *frames):
+    """Feed frames of (code, value) scroll events, then flush what's pending"""
+    for frame in frames:
+        for code, value in frame:
+            server.accumulate_scroll(Event(enums.EV_REL, code, value))
+        assert await server.end_scroll_frame() is False
+    server.sent = []
+    await server.flush_scroll()
+    return server.sent
+
+def test_scroll_ignores_low_res_in_hi_res_frames():
+    async def run():
+        server = scroller()
+        assert await scroll(server, [(HI, 120), (LO, 1)]) == [(HI, 120), (LO, 1)]
+        assert await scroll(server, [(LO, 1), (HI, 120)]) == [(HI, 120), (LO, 1)]
+    asyncio.run(run())
+
+def test_scroll_carries_remainder():
+    async def run():
+        server = scroller()
+        assert await scroll(server, *[[(HI, 30)]] * 5) == [(HI, 150), (LO, 1)]
+        assert server._scroll_rem[LO] == 30
+        assert await scroll(server, [(HI, 60)]) == [(HI, 60)]
+        assert await scroll(server, [(HI, 30)]) == [(HI, 30), (LO, 1)]
+        assert server._scroll_rem[LO] == 0
+    asyncio.run(run())
+
+def test_scroll_remainder_keeps_sign():
+    async def run():
+        server = scroller()
+        assert await scroll(server, [(HI, -50)]) == [(HI, -50)]
+        assert await scroll(server, [(HI, -80)]) == [(HI, -80), (LO, -1)]
+        assert server._scroll_rem[LO] == -10
+        #turning back cancels the carry instead of adding to it
+        assert await scroll(server, [(HI, 40)]) == [(HI, 40)]
+        assert server._scroll_rem[LO] == 30
+    asyncio.run(run())
+
+def test_scroll_low_res_only_device():
+    async def run():
+        server = scroller(hires=False)
+        frames = [[(enums.REL_HWHEEL, 1)], [(enums.REL_HWHEEL, 2)]]
+        assert await scroll(server, *frames) == [(enums.REL_HWHEEL, 3)]
+    asyncio.run(run())